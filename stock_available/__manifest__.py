@@ -11,9 +11,12 @@
     'depends': ['stock'],
     'license': 'AGPL-3',
     'data': [
+        'security/ir.model.access.csv',
+        'data/ir_cron.xml',
         'views/product_template_view.xml',
         'views/product_product_view.xml',
         'views/res_config_view.xml',
+        'views/stock_available_profile_view.xml',
     ],
     'installable': True,
 }
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from . import main
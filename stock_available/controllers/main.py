@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import json
+
+import odoo
+from odoo import api, http
+from odoo.http import request, Response
+
+from ..models.product_product import ATP_EXPORT_CHUNK_SIZE
+
+
+class StockAvailableController(http.Controller):
+
+    @http.route('/stock_available/atp', type='http', auth='user',
+                methods=['GET'])
+    def export_atp(self, locations=None, since=None, chunk_size=None,
+                   **kwargs):
+        """Stream the quantity available to promise of the storable products
+        as JSON lines.
+
+        The first line holds the `watermark` to pass as `since` to the next
+        call to get only the products changed in between, or null if the
+        changes are not logged. Each following
+        line holds a `product_id`, `default_code`, `location_id` and `qty`.
+
+        :param locations: comma-separated ids of locations; by default, the
+                          stock of all the warehouses is exported
+        :param since: watermark of a previous export; only export the
+                      products whose quantity may have changed since then
+        :param chunk_size: number of products computed at once
+        """
+        location_ids = None
+        if locations:
+            location_ids = [int(i) for i in locations.split(',')]
+        since = int(since) if since else None
+        if since is not None:
+            request.env['stock.available.atp.change'].check_watermark(since)
+        chunk_size = int(chunk_size or ATP_EXPORT_CHUNK_SIZE)
+        db, uid, context = request.db, request.uid, dict(request.context)
+
+        def generate():
+            # The response is streamed after the request's cursor is closed
+            with odoo.registry(db).cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                # First query: the watermark matches the snapshot read
+                watermark = env['stock.available.atp.change'].\
+                    get_watermark()
+                yield json.dumps({'watermark': watermark}) + '\n'
+                for rows in env['product.product']._iter_atp_export(
+                        location_ids, since, chunk_size):
+                    yield ''.join(
+                        json.dumps({'product_id': product_id,
+                                    'default_code': default_code,
+                                    'location_id': location_id,
+                                    'qty': qty}) + '\n'
+                        for product_id, default_code, location_id, qty
+                        in rows)
+
+        return Response(generate(), direct_passthrough=True,
+                        mimetype='application/x-ndjson')
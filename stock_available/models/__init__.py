@@ -5,4 +5,10 @@
 
 from . import product_template
 from . import product_product
+from . import ir_config_parameter
+from . import res_company
 from . import res_config
+from . import stock_move
+from . import stock_quant
+from . import stock_available_profile
+from . import stock_available_atp_change
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import re
+
+# An optionally signed term, with an optional coefficient: "- 2 * quoted"
+TERM_RE = re.compile(
+    r'\s*(?P<sign>[+-])?\s*'
+    r'(?:(?P<coefficient>\d+(?:\.\d*)?)\s*\*\s*)?'
+    r'(?P<term>[a-z_]+)\s*')
+
+
+def compile_atp_formula(formula):
+    """Compile a formula of the quantity available to promise.
+
+    A formula is a sum of terms such as
+    ``on_hand - outgoing + potential - quoted``, where each term can be
+    multiplied by a coefficient: ``on_hand + 0.5 * potential``.
+
+    :param formula: the formula to compile
+    :return: tuple of (coefficient, term) pairs
+    :raise ValueError: if the formula can't be parsed
+    """
+    plan = []
+    position = 0
+    formula = formula.strip()
+    while position < len(formula):
+        match = TERM_RE.match(formula, position)
+        if not match or match.end() == position:
+            raise ValueError("Syntax error at position %d" % position)
+        if plan and not match.group('sign'):
+            raise ValueError(
+                "Missing operator before %s" % match.group('term'))
+        coefficient = float(match.group('coefficient') or 1.0)
+        if match.group('sign') == '-':
+            coefficient = -coefficient
+        plan.append((coefficient, match.group('term')))
+        position = match.end()
+    return tuple(plan)
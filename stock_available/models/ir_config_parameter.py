@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+from .res_config import STOCK_AVAILABLE_PARAMS
+
+
+class IrConfigParameter(models.Model):
+    """Clear the cached settings of stock_available when they change"""
+    _inherit = 'ir.config_parameter'
+
+    @api.model
+    def create(self, vals):
+        if vals.get('key') in STOCK_AVAILABLE_PARAMS:
+            self.env['stock.config.settings'].clear_caches()
+        return super(IrConfigParameter, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if any(key in STOCK_AVAILABLE_PARAMS
+               for key in self.mapped('key') + [vals.get('key')]):
+            self.env['stock.config.settings'].clear_caches()
+        return super(IrConfigParameter, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        if any(key in STOCK_AVAILABLE_PARAMS for key in self.mapped('key')):
+            self.env['stock.config.settings'].clear_caches()
+        return super(IrConfigParameter, self).unlink()
@@ -3,8 +3,50 @@
 # Copyright 2016 Sodexis
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import models, fields, api
+import operator
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import timedelta
+
+from odoo import models, fields, api, tools, _
 from odoo.addons import decimal_precision as dp
+from odoo.exceptions import UserError
+from odoo.tools import float_round
+
+from .atp_formula import compile_atp_formula
+from .profiling import profiled
+
+OPERATORS = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '=': operator.eq,
+    '!=': operator.ne,
+}
+
+# Intervals of the projections of the quantity available to promise
+ATP_INTERVALS = ('day', 'week', 'month')
+
+# Terms of the ATP formulas computed by warehouse in a single query
+ATP_MATRIX_STOCK_TERMS = ('on_hand', 'incoming', 'outgoing', 'forecast',
+                          'reserved')
+
+# Number of products computed at once by the exports
+ATP_EXPORT_CHUNK_SIZE = 1000
+
+# Context keys restricting the stock computations
+STOCK_CONTEXT_KEYS = ('location', 'warehouse', 'lot_id', 'owner_id',
+                      'package_id', 'from_date', 'to_date')
+
+
+def _interval_start(day, interval):
+    """Return the first day of the interval containing *day*"""
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
 
 
 class ProductProduct(models.Model):
@@ -17,6 +59,7 @@ class ProductProduct(models.Model):
 
     @api.multi
     @api.depends('virtual_available')
+    @profiled('stock_available')
     def _compute_immediately_usable_qty(self):
         """No-op implementation of the stock available to promise.
 
@@ -27,8 +70,470 @@ class ProductProduct(models.Model):
             decide in advance how to compute the template's quantity from the
             variants.
         """
+        plan = self._get_atp_plan()
+        if plan:
+            quantities = self._evaluate_atp_plan(plan)
+        else:
+            quantities = self._get_immediately_usable_base_qty()
+        for prod in self:
+            prod.immediately_usable_qty = quantities[prod.id]
+
+    @api.multi
+    @profiled('stock_available')
+    def _get_immediately_usable_base_qty(self):
+        """Return the quantity the available to promise is based on.
+
+        By default this is the forecasted quantity. Sub-modules may compute
+        another base quantity for the whole recordset at once, instead of
+        adjusting the forecasted quantity afterwards.
+
+        :return: dict mapping the ids to their base quantity
+        """
+        return {prod.id: prod.virtual_available for prod in self}
+
+    @api.model
+    def _get_atp_terms(self):
+        """Return the terms available in the formulas of the quantity
+        available to promise.
+
+        Sub-modules may add their own terms.
+
+        :return: dict mapping each term to the name of a field, or of a method
+                 returning a dict mapping the ids to their quantity
+        """
+        return {
+            'on_hand': 'qty_available',
+            'incoming': 'incoming_qty',
+            'outgoing': 'outgoing_qty',
+            'forecast': 'virtual_available',
+            'potential': 'potential_qty',
+            'reserved': '_get_atp_reserved_qty',
+        }
+
+    @api.model
+    def _compile_atp_formula(self, formula):
+        """Compile *formula* and check its terms are known.
+
+        :return: tuple of (coefficient, term) pairs
+        :raise UserError: if the formula is invalid
+        """
+        try:
+            plan = compile_atp_formula(formula or '')
+        except ValueError as error:
+            raise UserError(
+                _("Invalid formula of the quantity available to promise: "
+                  "%s") % error)
+        terms = self._get_atp_terms()
+        unknown = [term for _coefficient, term in plan if term not in terms]
+        if unknown:
+            raise UserError(
+                _("Unknown terms in the formula of the quantity available "
+                  "to promise: %s.\nThe available terms are: %s.") % (
+                    ', '.join(unknown), ', '.join(sorted(terms))))
+        return plan
+
+    @api.model
+    def _get_atp_plan(self):
+        """Return the compiled formula of the current company, if any"""
+        company_id = (self.env.context.get('force_company') or
+                      self.env.user.company_id.id)
+        return self._get_atp_plan_company(company_id)
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_atp_plan_company(self, company_id):
+        """Compile the formula of the company once for all.
+
+        The cache is cleared when the formula of a company is changed.
+        """
+        company = self.env['res.company'].sudo().browse(company_id)
+        return self._compile_atp_formula(
+            company.stock_available_atp_formula)
+
+    @api.multi
+    def _evaluate_atp_plan(self, plan):
+        """Evaluate a compiled formula for the whole recordset, fetching
+        each term once for all the records.
+
+        :return: dict mapping the ids to their quantity available to promise
+        """
+        terms = self._get_atp_terms()
+        quantities = dict.fromkeys(self.ids, 0.0)
+        for coefficient, term in plan:
+            values = self._get_atp_term_values(terms[term])
+            for prod_id in quantities:
+                quantities[prod_id] += coefficient * values[prod_id]
+        return quantities
+
+    @api.multi
+    def _get_atp_term_values(self, name):
+        """Return the values of a term of the ATP formulas for all the
+        records at once.
+
+        :param name: name of a field, or of a method returning the values
+        :return: dict mapping the ids to the values of the term
+        """
+        if name in self._fields:
+            return {prod.id: prod[name] for prod in self}
+        return getattr(self, name)()
+
+    @api.multi
+    def _get_atp_reserved_qty(self):
+        """Return the quantity of the quants reserved for moves, in the
+        locations of the context."""
+        domain_quant_loc = self._get_domain_locations()[0]
+        groups = self.env['stock.quant'].read_group(
+            [('product_id', 'in', self.ids),
+             ('reservation_id', '!=', False)] + domain_quant_loc,
+            ['product_id', 'qty'], ['product_id'])
+        quantities = dict.fromkeys(self.ids, 0.0)
+        for group in groups:
+            quantities[group['product_id'][0]] = group['qty']
+        return quantities
+
+    @api.multi
+    def get_atp_projection(self, date_from=None, date_to=None,
+                           interval='day'):
+        """Project the quantity available to promise over a horizon.
+
+        The projection starts from the current quantity available to
+        promise, computed with the formula of the company or the default
+        formula of the installed modules. The terms of the formula are then
+        changed by the events expected at each date (see
+        `_get_atp_projection_events`), and the cumulated quantity is
+        reported for each interval.
+        The events of all the products are fetched at once, then swept once
+        in date order.
+
+        :param date_from: first day of the horizon, today by default
+        :param date_to: last day of the horizon, 4 weeks after the first day
+                        by default
+        :param interval: one of `ATP_INTERVALS`
+        :return: dict mapping the ids to a list of (date of the start of the
+                 interval, quantity available to promise at the end of the
+                 interval) pairs
+        """
+        if interval not in ATP_INTERVALS:
+            raise UserError(_("Invalid interval: %s") % interval)
+        date_from = fields.Date.from_string(
+            date_from or fields.Date.context_today(self))
+        date_to = (fields.Date.from_string(date_to) if date_to
+                   else date_from + timedelta(days=27))
+        starts = sorted({_interval_start(date_from + timedelta(days=days),
+                                         interval)
+                         for days in range((date_to - date_from).days + 1)})
+
+        plan = self._get_atp_plan() or self._get_atp_matrix_default_plan()
+        coefficients = defaultdict(float)
+        for coefficient, term in plan:
+            coefficients[term] += coefficient
+        current = self._evaluate_atp_plan(plan)
+
+        changes = defaultdict(lambda: [0.0] * len(starts))
+        for prod_id, day, term, qty in self._get_atp_projection_events(
+                date_from, date_to, set(coefficients)):
+            if day > date_to or not coefficients[term]:
+                continue
+            # Late events count from the start of the horizon
+            index = max(bisect_right(starts, day) - 1, 0)
+            changes[prod_id][index] += coefficients[term] * qty
+
+        projection = {}
+        for prod in self:
+            quantity = current[prod.id]
+            curve = []
+            for start, change in zip(starts, changes[prod.id]):
+                quantity += change
+                curve.append((fields.Date.to_string(start),
+                              float_round(quantity, precision_rounding=(
+                                  prod.uom_id.rounding))))
+            projection[prod.id] = curve
+        return projection
+
+    @api.multi
+    def _get_atp_projection_events(self, date_from, date_to, terms):
+        """Return the changes of the terms of the ATP formulas expected for
+        the whole recordset, in the locations of the context.
+
+        By default, the incoming and outgoing moves change the stock on hand
+        and the incoming or outgoing quantity at their expected date; the
+        forecasted quantity doesn't change. The other terms are considered
+        constant. Sub-modules may add the changes of their own terms, and
+        must fetch them for all the records at once.
+
+        :param date_from: first day of the horizon, as a date
+        :param date_to: last day of the horizon, as a date
+        :param terms: set of the terms used by the formula
+        :return: list of (product id, date, term, change) tuples
+        """
+        events = []
+        if not terms & {'on_hand', 'incoming', 'outgoing'}:
+            return events
+        move_obj = self.env['stock.move']
+        _domain_quant_loc, domain_move_in_loc, domain_move_out_loc = \
+            self._get_domain_locations()
+        date_limit = fields.Datetime.to_string(
+            fields.Datetime.from_string(fields.Date.to_string(date_to)) +
+            timedelta(days=1))
+        for sign, term, domain_loc in ((1.0, 'incoming', domain_move_in_loc),
+                                       (-1.0, 'outgoing',
+                                        domain_move_out_loc)):
+            query = move_obj._where_calc(
+                [('product_id', 'in', self.ids),
+                 ('state', 'not in', ('done', 'cancel', 'draft')),
+                 ('date_expected', '<', date_limit)] + domain_loc)
+            move_obj._apply_ir_rules(query, 'read')
+            from_clause, where_clause, params = query.get_sql()
+            self.env.cr.execute("""
+                SELECT "stock_move".product_id,
+                       "stock_move".date_expected::date,
+                       SUM("stock_move".product_qty)
+                FROM %s
+                WHERE %s
+                GROUP BY 1, 2
+                """ % (from_clause, where_clause), params)
+            for prod_id, day, qty in self.env.cr.fetchall():
+                events.append((prod_id, day, 'on_hand', sign * qty))
+                events.append((prod_id, day, term, -qty))
+        return events
+
+    @api.multi
+    def get_atp_matrix(self, warehouse_ids=None):
+        """Compute the current quantity available to promise of each product
+        in each warehouse at once.
+
+        The terms of the formula of the company, or of the default formula
+        of the installed modules, are computed for all the warehouses in one
+        pass and then combined in each cell.
+
+        :param warehouse_ids: ids of the warehouses, all by default
+        :return: dict mapping the product ids to dicts mapping the warehouse
+                 ids to the quantity available to promise
+        """
+        warehouse_obj = self.env['stock.warehouse']
+        if warehouse_ids is None:
+            warehouses = warehouse_obj.search([])
+        else:
+            warehouses = warehouse_obj.browse(warehouse_ids)
+        plan = self._get_atp_plan() or self._get_atp_matrix_default_plan()
+        values = self._get_atp_matrix_values(
+            {term for _coefficient, term in plan}, warehouses)
+        matrix = {}
         for prod in self:
-            prod.immediately_usable_qty = prod.virtual_available
+            row = matrix[prod.id] = {}
+            for warehouse in warehouses:
+                qty = sum(coefficient *
+                          values[term].get((prod.id, warehouse.id), 0.0)
+                          for coefficient, term in plan)
+                row[warehouse.id] = float_round(
+                    qty, precision_rounding=prod.uom_id.rounding)
+        return matrix
+
+    @api.model
+    def _get_atp_matrix_default_plan(self):
+        """Return the formula equivalent to the computation of the quantity
+        available to promise when the company has no formula.
+
+        Each sub-module adjusting the quantity must add its terms.
+
+        :return: tuple of (coefficient, term) pairs
+        """
+        return ((1.0, 'forecast'),)
+
+    @api.multi
+    def _get_atp_matrix_values(self, terms, warehouses):
+        """Return the values of some terms of the ATP formulas for each
+        product and warehouse.
+
+        The quantities in stock and in moves are computed in one query.
+        The other terms are computed warehouse by warehouse, unless a
+        sub-module computes them for all the warehouses at once.
+
+        :param terms: set of terms
+        :param warehouses: recordset of warehouses
+        :return: dict mapping each term to a dict mapping (product id,
+                 warehouse id) pairs to the values
+        """
+        values = {}
+        if set(terms) & set(ATP_MATRIX_STOCK_TERMS):
+            values.update(self._get_atp_matrix_stock_values(warehouses))
+        context = {key: value for key, value in self.env.context.items()
+                   if key not in STOCK_CONTEXT_KEYS}
+        atp_terms = self._get_atp_terms()
+        for term in set(terms) - set(values):
+            cells = values[term] = {}
+            for warehouse in warehouses:
+                term_values = self.with_context(
+                    context, warehouse=warehouse.id)._get_atp_term_values(
+                    atp_terms[term])
+                cells.update(((prod_id, warehouse.id), qty)
+                             for prod_id, qty in term_values.items())
+        return values
+
+    @api.multi
+    def _get_atp_matrix_stock_values(self, warehouses):
+        """Compute the quantities on hand, reserved, incoming, outgoing and
+        forecasted of each product in each warehouse, in a single query
+        grouping the quants and moves by warehouse.
+
+        :return: dict mapping the terms of `ATP_MATRIX_STOCK_TERMS` to dicts
+                 mapping (product id, warehouse id) pairs to the quantities
+        """
+        values = {term: {} for term in ATP_MATRIX_STOCK_TERMS}
+        if not self.ids or not warehouses:
+            return values
+        quant_obj = self.env['stock.quant']
+        move_obj = self.env['stock.move']
+        quant_query = quant_obj._where_calc(
+            [('product_id', 'in', self.ids)])
+        quant_obj._apply_ir_rules(quant_query, 'read')
+        quant_from, quant_where, quant_params = quant_query.get_sql()
+        move_query = move_obj._where_calc(
+            [('product_id', 'in', self.ids),
+             ('state', 'not in', ('done', 'cancel', 'draft'))])
+        move_obj._apply_ir_rules(move_query, 'read')
+        move_from, move_where, move_params = move_query.get_sql()
+
+        # A location is in a warehouse if it is a child of its view location
+        in_warehouse = """
+            %(location)s.parent_left >= warehouse.parent_left
+            AND %(location)s.parent_left < warehouse.parent_right"""
+        in_source = in_warehouse % {'location': 'source'}
+        in_dest = in_warehouse % {'location': 'dest'}
+        self.env.cr.execute("""
+            WITH warehouse AS (
+                SELECT stock_warehouse.id,
+                       stock_location.parent_left,
+                       stock_location.parent_right
+                FROM stock_warehouse
+                INNER JOIN stock_location
+                     ON (stock_location.id = stock_warehouse.view_location_id)
+                WHERE stock_warehouse.id IN %%s
+            )
+            SELECT product_id, warehouse_id, term, SUM(qty)
+            FROM (
+                SELECT "stock_quant".product_id, warehouse.id AS warehouse_id,
+                       CASE WHEN "stock_quant".reservation_id IS NULL
+                            THEN 'on_hand' ELSE 'reserved'
+                       END AS term,
+                       "stock_quant".qty
+                FROM %s, stock_location dest, warehouse
+                WHERE %s
+                      AND dest.id = "stock_quant".location_id
+                      AND %s
+                UNION ALL
+                SELECT "stock_move".product_id, warehouse.id,
+                       CASE WHEN %s THEN 'outgoing' ELSE 'incoming' END,
+                       "stock_move".product_qty
+                FROM %s, stock_location source, stock_location dest,
+                     warehouse
+                WHERE %s
+                      AND source.id = "stock_move".location_id
+                      AND dest.id = "stock_move".location_dest_id
+                      AND (%s) != (%s)
+            ) AS atp
+            GROUP BY product_id, warehouse_id, term
+            """ % (quant_from, quant_where, in_dest, in_source,
+                   move_from, move_where, in_source, in_dest),
+            [tuple(warehouses.ids)] + quant_params + move_params)
+        for prod_id, warehouse_id, term, qty in self.env.cr.fetchall():
+            values[term][(prod_id, warehouse_id)] = qty
+        # Reserved quants are on hand too
+        for cell, qty in values['reserved'].items():
+            values['on_hand'][cell] = values['on_hand'].get(cell, 0.0) + qty
+        for term, sign in (('on_hand', 1.0), ('incoming', 1.0),
+                           ('outgoing', -1.0)):
+            for cell, qty in values[term].items():
+                values['forecast'][cell] = (
+                    values['forecast'].get(cell, 0.0) + sign * qty)
+        return values
+
+    @api.model
+    def _iter_atp_export(self, location_ids=None, since=None,
+                         chunk_size=ATP_EXPORT_CHUNK_SIZE):
+        """Compute the quantity available to promise of the storable
+        products, chunk by chunk.
+
+        Each chunk is computed at once for each location, and the cache is
+        emptied after each chunk so that the whole catalogue can be exported
+        without growing the memory.
+
+        :param location_ids: ids of the locations, or None for the stock of
+                             all the warehouses
+        :param since: watermark of a previous export (see
+                      `stock.available.atp.change`); if set, only the
+                      products whose quantity may have changed since then
+                      are exported, and the ones deleted or not storable
+                      any more are exported with a quantity of 0
+        :param chunk_size: number of products per chunk
+        :return: generator of lists of (product id, internal reference,
+                 location id or False, quantity) tuples
+        """
+        context = {key: value for key, value in self.env.context.items()
+                   if key not in STOCK_CONTEXT_KEYS}
+        domain = [('type', '=', 'product')]
+        if since is not None:
+            changed_ids = self._get_atp_changed_product_ids(since)
+            domain.append(('id', 'in', list(changed_ids)))
+        products = self.with_context(context).search(domain, order='id')
+        for start in range(0, len(products), chunk_size):
+            chunk = products[start:start + chunk_size]
+            rows = []
+            for location_id in location_ids or [False]:
+                located = chunk
+                if location_id:
+                    located = chunk.with_context(location=location_id)
+                rows.extend((product.id, product.default_code or False,
+                             location_id, product.immediately_usable_qty)
+                            for product in located)
+            chunk.invalidate_cache()
+            yield rows
+        if since is not None:
+            gone_ids = sorted(changed_ids - set(products.ids))
+            for start in range(0, len(gone_ids), chunk_size):
+                yield [(product_id, False, location_id, 0.0)
+                       for product_id in gone_ids[start:start + chunk_size]
+                       for location_id in location_ids or [False]]
+
+    @api.model
+    def _get_atp_changed_product_ids(self, since):
+        """Return the ids of the products whose quantity available to
+        promise may have changed since a watermark.
+
+        :param since: watermark of a previous export
+        :return: set of product ids
+        """
+        return self.env['stock.available.atp.change'].get_product_ids(since)
+
+    @api.multi
+    def _notify_atp_change(self):
+        """Record that the quantity available to promise of the products,
+        and of the products depending on them, may have changed, and
+        refresh their stored quantity.
+
+        Nothing is done unless the change log or the stored mode is enabled.
+        """
+        change_obj = self.env['stock.available.atp.change']
+        logged = change_obj.is_enabled()
+        stored = self._is_immediately_usable_qty_stored()
+        if not self or not (logged or stored):
+            return
+        products = self._get_atp_dependent_products()
+        if logged:
+            change_obj.log_products(products.ids)
+        if stored:
+            products._refresh_immediately_usable_qty_stored()
+
+    @api.model
+    def create(self, vals):
+        product = super(ProductProduct, self).create(vals)
+        product._notify_atp_change()
+        return product
+
+    @api.multi
+    def unlink(self):
+        self.env['stock.available.atp.change'].log_products(self.ids)
+        return super(ProductProduct, self).unlink()
 
     @api.multi
     @api.depends()
@@ -39,14 +544,71 @@ class ProductProduct(models.Model):
         for product in self:
             product.potential_qty = 0.0
 
+    @api.model
+    def _is_immediately_usable_qty_stored(self):
+        """Tell whether the stored available to promise is maintained"""
+        return bool(self.env['stock.config.settings'].
+                    get_stock_available_param('stock_available_stored_atp'))
+
+    @api.multi
+    def _get_atp_dependent_products(self):
+        """Return the products whose quantity available to promise depends
+        on the stock of these products, including themselves"""
+        return self
+
+    @api.multi
+    def _refresh_immediately_usable_qty_stored(self, force=False):
+        """Store the quantity available to promise of the products and of
+        their templates, without any location or date in the context.
+
+        Nothing is done unless the stored mode is enabled or *force* is set.
+        """
+        if not self or not (force or self._is_immediately_usable_qty_stored()):
+            return
+        context = {key: value for key, value in self.env.context.items()
+                   if key not in STOCK_CONTEXT_KEYS}
+        products = self.exists().sudo().with_context(context)
+        products.invalidate_cache(ids=products.ids)
+        self.env.cr.executemany(
+            "UPDATE product_product SET immediately_usable_qty_stored = %s "
+            "WHERE id = %s",
+            [(product.immediately_usable_qty, product.id)
+             for product in products])
+        products.invalidate_cache(['immediately_usable_qty_stored'],
+                                  products.ids)
+        products.mapped('product_tmpl_id').\
+            _refresh_immediately_usable_qty_stored(force=True)
+
+    def _search_immediately_usable_qty(self, operator, value):
+        """Search on the stored quantity if it is maintained, otherwise
+        compute the quantity for all the storable products"""
+        if operator not in OPERATORS:
+            raise ValueError('Invalid domain operator %s' % operator)
+        if self._is_immediately_usable_qty_stored():
+            return [('immediately_usable_qty_stored', operator, value)]
+        products = self.search([('type', '=', 'product')])
+        return [('id', 'in', [
+            product.id for product in products
+            if OPERATORS[operator](product.immediately_usable_qty, value)])]
+
     immediately_usable_qty = fields.Float(
         digits=dp.get_precision('Product Unit of Measure'),
         compute='_compute_immediately_usable_qty',
+        search='_search_immediately_usable_qty',
         string='Available to promise',
         help="Stock for this Product that can be safely proposed "
              "for sale to Customers.\n"
              "The definition of this value can be configured to suit "
              "your needs")
+    immediately_usable_qty_stored = fields.Float(
+        digits=dp.get_precision('Product Unit of Measure'),
+        string='Available to promise (stored)',
+        readonly=True,
+        index=True,
+        copy=False,
+        help="Quantity available to promise for all the warehouses, kept "
+             "up to date when the stored mode is enabled in the settings, "
+             "so that it can be searched, sorted and grouped on.")
     potential_qty = fields.Float(
         compute='_compute_potential_qty',
         digits=dp.get_precision('Product Unit of Measure'),
@@ -6,12 +6,16 @@
 from odoo import models, fields, api
 from odoo.addons import decimal_precision as dp
 
+from .product_product import OPERATORS, STOCK_CONTEXT_KEYS
+from .profiling import profiled
+
 
 class ProductTemplate(models.Model):
     _inherit = 'product.template'
 
     @api.multi
     @api.depends('product_variant_ids.immediately_usable_qty')
+    @profiled('stock_available')
     def _compute_immediately_usable_qty(self):
         """No-op implementation of the stock available to promise.
 
@@ -22,8 +26,63 @@ class ProductTemplate(models.Model):
             decide in advance how to compute the template's quantity from the
             variants.
         """
+        plan = self.env['product.product']._get_atp_plan()
+        if plan:
+            quantities = self._evaluate_atp_plan(plan)
+        else:
+            quantities = self._get_immediately_usable_base_qty()
         for tmpl in self:
-            tmpl.immediately_usable_qty = tmpl.virtual_available
+            tmpl.immediately_usable_qty = quantities[tmpl.id]
+
+    @api.multi
+    @profiled('stock_available')
+    def _get_immediately_usable_base_qty(self):
+        """Return the quantity the available to promise is based on.
+
+        By default this is the forecasted quantity. Sub-modules may compute
+        another base quantity for the whole recordset at once, instead of
+        adjusting the forecasted quantity afterwards.
+
+        :return: dict mapping the ids to their base quantity
+        """
+        return {tmpl.id: tmpl.virtual_available for tmpl in self}
+
+    @api.multi
+    def _evaluate_atp_plan(self, plan):
+        """Evaluate a compiled formula for the whole recordset, fetching
+        each term once for all the records.
+
+        :return: dict mapping the ids to their quantity available to promise
+        """
+        terms = self.env['product.product']._get_atp_terms()
+        quantities = dict.fromkeys(self.ids, 0.0)
+        for coefficient, term in plan:
+            values = self._get_atp_term_values(terms[term])
+            for tmpl_id in quantities:
+                quantities[tmpl_id] += coefficient * values[tmpl_id]
+        return quantities
+
+    @api.multi
+    def _get_atp_term_values(self, name):
+        """Return the values of a term of the ATP formulas for all the
+        records at once.
+
+        The terms which are not fields of the templates are the sum of the
+        values of the variants.
+
+        :param name: name of a field, or of a method of the variants
+                     returning the values
+        :return: dict mapping the ids to the values of the term
+        """
+        if name in self._fields:
+            return {tmpl.id: tmpl[name] for tmpl in self}
+        variant_values = self.mapped('product_variant_ids').\
+            _get_atp_term_values(name)
+        return {
+            tmpl.id: sum(variant_values[variant.id]
+                         for variant in tmpl.product_variant_ids)
+            for tmpl in self
+        }
 
     @api.multi
     @api.depends('product_variant_ids.potential_qty')
@@ -41,14 +100,66 @@ class ProductTemplate(models.Model):
             tmpl.potential_qty = max(
                 [v.potential_qty for v in tmpl.product_variant_ids])
 
+    @api.multi
+    def write(self, vals):
+        res = super(ProductTemplate, self).write(vals)
+        if 'type' in vals:
+            # The products become exported, or not any more
+            self.mapped('product_variant_ids')._notify_atp_change()
+        return res
+
+    @api.multi
+    def _refresh_immediately_usable_qty_stored(self, force=False):
+        """Store the quantity available to promise of the templates, without
+        any location or date in the context.
+
+        Nothing is done unless the stored mode is enabled or *force* is set.
+        """
+        product_obj = self.env['product.product']
+        if not self or not (
+                force or product_obj._is_immediately_usable_qty_stored()):
+            return
+        context = {key: value for key, value in self.env.context.items()
+                   if key not in STOCK_CONTEXT_KEYS}
+        templates = self.exists().sudo().with_context(context)
+        templates.invalidate_cache(ids=templates.ids)
+        self.env.cr.executemany(
+            "UPDATE product_template SET immediately_usable_qty_stored = %s "
+            "WHERE id = %s",
+            [(tmpl.immediately_usable_qty, tmpl.id) for tmpl in templates])
+        templates.invalidate_cache(['immediately_usable_qty_stored'],
+                                   templates.ids)
+
+    def _search_immediately_usable_qty(self, operator, value):
+        """Search on the stored quantity if it is maintained, otherwise
+        compute the quantity for all the storable products"""
+        if operator not in OPERATORS:
+            raise ValueError('Invalid domain operator %s' % operator)
+        if self.env['product.product']._is_immediately_usable_qty_stored():
+            return [('immediately_usable_qty_stored', operator, value)]
+        templates = self.search([('type', '=', 'product')])
+        return [('id', 'in', [
+            tmpl.id for tmpl in templates
+            if OPERATORS[operator](tmpl.immediately_usable_qty, value)])]
+
     immediately_usable_qty = fields.Float(
         digits=dp.get_precision('Product Unit of Measure'),
         compute='_compute_immediately_usable_qty',
+        search='_search_immediately_usable_qty',
         string='Available to promise',
         help="Stock for this Product that can be safely proposed "
              "for sale to Customers.\n"
              "The definition of this value can be configured to suit "
              "your needs")
+    immediately_usable_qty_stored = fields.Float(
+        digits=dp.get_precision('Product Unit of Measure'),
+        string='Available to promise (stored)',
+        readonly=True,
+        index=True,
+        copy=False,
+        help="Quantity available to promise for all the warehouses, kept "
+             "up to date when the stored mode is enabled in the settings, "
+             "so that it can be searched, sorted and grouped on.")
     potential_qty = fields.Float(
         compute='_compute_potential_qty',
         digits=dp.get_precision('Product Unit of Measure'),
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+"""Lightweight profiling of the computations of the quantities.
+
+Each module computing a part of the quantity available to promise (a
+"layer") decorates its compute methods with `profiled`. When the system
+parameter `stock_available_profiling` is set, the number of queries and
+the time spent in each layer are recorded in memory, per database, and
+logged as a JSON line.
+
+The figures of a layer include the layers it calls through `super()`;
+the "self" figures exclude them.
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+# Statistics per database, then per (layer, method, batch size)
+PROFILE_STATS = defaultdict(lambda: defaultdict(Counter))
+
+# Stack of the computations being profiled in the current thread
+_local = threading.local()
+
+
+def batch_size_class(size):
+    """Round a batch size down to a power of ten, so that the statistics
+    don't grow with each new batch size."""
+    size_class = 1
+    while size_class * 10 <= size:
+        size_class *= 10
+    return size_class
+
+
+@contextmanager
+def profile(env, layer, method, size):
+    """Record the queries and time spent in the block, if enabled.
+
+    :param layer: name of the module doing the computation
+    :param method: name of the method doing the computation
+    :param size: number of records computed at once
+    """
+    if not env['stock.config.settings'].get_stock_available_param(
+            'stock_available_profiling'):
+        yield
+        return
+    stack = _local.__dict__.setdefault('stack', [])
+    children = Counter()
+    stack.append(children)
+    cr = env.cr
+    queries = cr.sql_log_count
+    start = time.time()
+    try:
+        yield
+    finally:
+        stack.pop()
+        figures = Counter(
+            calls=1,
+            records=size,
+            queries=cr.sql_log_count - queries,
+            seconds=time.time() - start)
+        figures['self_queries'] = figures['queries'] - children['queries']
+        figures['self_seconds'] = figures['seconds'] - children['seconds']
+        if stack:
+            stack[-1].update(queries=figures['queries'],
+                             seconds=figures['seconds'])
+        PROFILE_STATS[cr.dbname][
+            (layer, method, batch_size_class(size))].update(figures)
+        _logger.info('stock_available profile %s', json.dumps(
+            dict(figures, layer=layer, method=method, db=cr.dbname),
+            sort_keys=True))
+
+
+def profiled(layer):
+    """Decorate a compute method of a recordset to profile it."""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            name = '%s.%s' % (self._name, method.__name__)
+            with profile(self.env, layer, name, len(self)):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
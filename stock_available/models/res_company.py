@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models, fields
+
+
+class ResCompany(models.Model):
+    _inherit = 'res.company'
+
+    stock_available_atp_formula = fields.Char(
+        string='Formula of the quantity available to promise',
+        help="Sum of terms defining the quantity available to promise, "
+             "for example: on_hand - outgoing + potential.\n"
+             "Each term may be multiplied by a coefficient, for example: "
+             "on_hand + 0.5 * potential.\n"
+             "If empty, the quantity depends on the modules installed.")
+
+    @api.constrains('stock_available_atp_formula')
+    def _check_stock_available_atp_formula(self):
+        product_obj = self.env['product.product']
+        for company in self:
+            product_obj._compile_atp_formula(
+                company.stock_available_atp_formula)
+
+    @api.multi
+    def write(self, vals):
+        if 'stock_available_atp_formula' in vals:
+            # Forget the compiled formulas
+            self.env['product.product'].clear_caches()
+        return super(ResCompany, self).write(vals)
@@ -3,7 +3,17 @@
 # Copyright 2016 Sodexis
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, models, fields
+from odoo import api, models, fields, tools
+
+# System parameters of the stock_available modules, with their defaults
+STOCK_AVAILABLE_PARAMS = {
+    'stock_available_mrp_based_on': 'qty_available',
+    'stock_available_mrp_template_potential': 'max',
+    'stock_available_mrp_joint_time_budget': '0.5',
+    'stock_available_stored_atp': '',
+    'stock_available_atp_change_log': '',
+    'stock_available_profiling': '',
+}
 
 
 class StockConfig(models.TransientModel):
@@ -11,6 +21,24 @@ class StockConfig(models.TransientModel):
     """Add options to easily install the submodules"""
     _inherit = 'stock.config.settings'
 
+    @api.model
+    def get_stock_available_param(self, key):
+        """Return the value of a system parameter of the stock_available
+        modules, without querying the database each time.
+
+        :param key: one of the keys of `STOCK_AVAILABLE_PARAMS`
+        """
+        return self._get_stock_available_params()[key]
+
+    @api.model
+    @tools.ormcache()
+    def _get_stock_available_params(self):
+        """Read all the parameters at once. The cache is cleared when one of
+        them is changed, see `ir.config_parameter`."""
+        icp = self.env['ir.config_parameter'].sudo()
+        return {key: icp.get_param(key, default)
+                for key, default in STOCK_AVAILABLE_PARAMS.items()}
+
     @api.model
     def _get_stock_available_mrp_based_on(self):
         """Gets the available languages for the selection."""
@@ -53,6 +81,48 @@ class StockConfig(models.TransientModel):
              "Only the quantity fields have meaning for computing stock",
     )
 
+    stock_available_mrp_template_potential = fields.Selection(
+        [('max', 'Biggest potential of a single variant'),
+         ('joint', 'Potential of all the variants together')],
+        string='Potential of products with variants',
+        help="Choose how the potential of a product with several variants "
+             "is computed.\nThe potential of all the variants together "
+             "shares the components between the variants, and requires "
+             "NumPy.",
+    )
+
+    stock_available_stored_atp = fields.Boolean(
+        string='Store the quantity available to promise',
+        help="Keep the quantity available to promise of all the warehouses "
+             "up to date in the database when stock moves, quants or "
+             "quotations change, so that products can be searched, sorted "
+             "and grouped on it.\n"
+             "This slows down the stock operations.")
+
+    stock_available_atp_change_log = fields.Boolean(
+        string='Log the changes of the quantity available to promise',
+        help="Record the products whose quantity available to promise may "
+             "change, so that the download of the quantities can be "
+             "limited to the products changed since the previous one.\n"
+             "This slows down the stock operations.")
+
+    stock_available_profiling = fields.Boolean(
+        string='Profile the quantity available to promise',
+        help="Record the number of queries and the time spent by each "
+             "module computing the quantity available to promise, and log "
+             "them.\nThe figures are shown in Inventory > Configuration > "
+             "Profile of the quantity available to promise, in developer "
+             "mode.")
+
+    stock_available_atp_formula = fields.Char(
+        related='company_id.stock_available_atp_formula',
+        string='Formula of the quantity available to promise',
+        help="Sum of terms defining the quantity available to promise, "
+             "for example: on_hand - outgoing + potential - reserved.\n"
+             "Each term may be multiplied by a coefficient, for example: "
+             "on_hand + 0.5 * potential.\n"
+             "If empty, the quantity depends on the modules installed.")
+
     @api.model
     def get_default_stock_available_mrp_based_on(self, fields):
         res = {}
@@ -68,3 +138,72 @@ class StockConfig(models.TransientModel):
             icp = self.env['ir.config_parameter']
             icp.set_param('stock_available_mrp_based_on',
                           self.stock_available_mrp_based_on)
+
+    @api.model
+    def get_default_stock_available_mrp_template_potential(self, fields):
+        icp = self.env['ir.config_parameter']
+        return {
+            'stock_available_mrp_template_potential': icp.get_param(
+                'stock_available_mrp_template_potential', 'max'),
+        }
+
+    @api.multi
+    def set_stock_available_mrp_template_potential(self):
+        if self.stock_available_mrp_template_potential:
+            icp = self.env['ir.config_parameter']
+            icp.set_param('stock_available_mrp_template_potential',
+                          self.stock_available_mrp_template_potential)
+
+    @api.model
+    def get_default_stock_available_stored_atp(self, fields):
+        icp = self.env['ir.config_parameter']
+        return {
+            'stock_available_stored_atp': bool(
+                icp.get_param('stock_available_stored_atp', False)),
+        }
+
+    @api.multi
+    def set_stock_available_stored_atp(self):
+        icp = self.env['ir.config_parameter']
+        was_stored = bool(icp.get_param('stock_available_stored_atp', False))
+        icp.set_param('stock_available_stored_atp',
+                      self.stock_available_stored_atp and 'True' or '')
+        if self.stock_available_stored_atp and not was_stored:
+            # Initialize the stored quantities
+            self.env['product.product'].search(
+                [('type', '=', 'product')]
+            )._refresh_immediately_usable_qty_stored(force=True)
+
+    @api.model
+    def get_default_stock_available_atp_change_log(self, fields):
+        icp = self.env['ir.config_parameter']
+        return {
+            'stock_available_atp_change_log': bool(
+                icp.get_param('stock_available_atp_change_log', False)),
+        }
+
+    @api.multi
+    def set_stock_available_atp_change_log(self):
+        icp = self.env['ir.config_parameter']
+        was_logged = bool(icp.get_param('stock_available_atp_change_log',
+                                        False))
+        if self.stock_available_atp_change_log and not was_logged:
+            # The changes are logged from this transaction on
+            icp.set_param('stock_available_atp_change_log', str(
+                self.env['stock.available.atp.change'].get_current_txid()))
+        elif not self.stock_available_atp_change_log:
+            icp.set_param('stock_available_atp_change_log', '')
+
+    @api.model
+    def get_default_stock_available_profiling(self, fields):
+        icp = self.env['ir.config_parameter']
+        return {
+            'stock_available_profiling': bool(
+                icp.get_param('stock_available_profiling', False)),
+        }
+
+    @api.multi
+    def set_stock_available_profiling(self):
+        icp = self.env['ir.config_parameter']
+        icp.set_param('stock_available_profiling',
+                      self.stock_available_profiling and 'True' or '')
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import logging
+
+from odoo import api, models, _
+from odoo.exceptions import UserError
+
+_logger = logging.getLogger(__name__)
+
+# Number of days the changes are kept for the delta exports
+ATP_CHANGE_RETENTION_DAYS = 30
+
+
+class StockAvailableAtpChange(models.Model):
+    """Log of the products whose quantity available to promise may have
+    changed, for the delta exports.
+
+    Each change is stamped with the id of the transaction which made it.
+    An export returns as watermark the oldest transaction still running
+    when it started: the next export with this watermark reads the changes
+    of all the transactions committed since, even the ones which started
+    before the previous export. Some changes may be exported twice, none is
+    missed.
+
+    The log is only appended to, so that concurrent transactions never
+    update the same rows. It is filled with SQL and is not an ORM table.
+
+    The log is only filled when it is enabled in the settings. The system
+    parameter holds the id of the transaction which enabled it: the
+    watermarks taken before are refused.
+    """
+    _name = 'stock.available.atp.change'
+    _description = 'Change of the quantity available to promise'
+    _auto = False
+
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS stock_available_atp_change (
+                id serial PRIMARY KEY,
+                product_id integer NOT NULL,
+                txid bigint NOT NULL DEFAULT txid_current(),
+                create_date timestamp NOT NULL
+                    DEFAULT (now() AT TIME ZONE 'UTC')
+            )
+            """)
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_indexes "
+            "WHERE indexname = 'stock_available_atp_change_txid_index'")
+        if not self.env.cr.fetchone():
+            self.env.cr.execute(
+                "CREATE INDEX stock_available_atp_change_txid_index "
+                "ON stock_available_atp_change (txid)")
+
+    @api.model
+    def _get_log_start(self):
+        """Return the id of the transaction which enabled the log, or None
+        if it is disabled"""
+        start = self.env['stock.config.settings'].get_stock_available_param(
+            'stock_available_atp_change_log')
+        return int(start) if start else None
+
+    @api.model
+    def is_enabled(self):
+        """Tell whether the changes are logged"""
+        return self._get_log_start() is not None
+
+    @api.model
+    def get_current_txid(self):
+        """Return the id of the current transaction"""
+        self.env.cr.execute("SELECT txid_current()")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def log_products(self, product_ids):
+        """Record that the quantity of some products may have changed in
+        the current transaction, if the log is enabled"""
+        if product_ids and self.is_enabled():
+            self.env.cr.execute(
+                "INSERT INTO stock_available_atp_change (product_id) "
+                "SELECT unnest(%s)", (sorted(set(product_ids)),))
+
+    @api.model
+    def get_watermark(self):
+        """Return the watermark to read the changes committed after the
+        snapshot of the current transaction, or None if the log is
+        disabled"""
+        if not self.is_enabled():
+            return None
+        self.env.cr.execute(
+            "SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def check_watermark(self, watermark):
+        """Raise an error if the changes since a watermark are not all
+        logged"""
+        start = self._get_log_start()
+        if start is None:
+            raise UserError(_('The changes of the quantity available to '
+                              'promise are not logged.'))
+        if int(watermark) < start:
+            raise UserError(_('The changes of the quantity available to '
+                              'promise are logged since a later watermark: '
+                              'export all the products again.'))
+
+    @api.model
+    def get_product_ids(self, watermark):
+        """Return the ids of the products changed by the transactions
+        at or after a watermark"""
+        self.check_watermark(watermark)
+        self.env.cr.execute(
+            "SELECT DISTINCT product_id FROM stock_available_atp_change "
+            "WHERE txid >= %s", (int(watermark),))
+        return {row[0] for row in self.env.cr.fetchall()}
+
+    @api.model
+    def purge(self, days=ATP_CHANGE_RETENTION_DAYS):
+        """Delete the changes older than a number of days.
+
+        The delta exports whose watermark is older must export the whole
+        catalogue again.
+        """
+        self.env.cr.execute(
+            "DELETE FROM stock_available_atp_change "
+            "WHERE create_date < (now() AT TIME ZONE 'UTC') - %s * "
+            "interval '1 day'", (days,))
+        _logger.info('Purged %d changes of the quantity available to '
+                     'promise', self.env.cr.rowcount)
+        return True
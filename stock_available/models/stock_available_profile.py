@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models, fields
+
+from .profiling import PROFILE_STATS
+
+
+class StockAvailableProfile(models.TransientModel):
+    """Report of the cost of the computations of the quantities, per layer
+    and per batch size.
+
+    The statistics are kept in the memory of each server process, so with
+    several workers the report only shows the process which served it."""
+    _name = 'stock.available.profile'
+    _description = 'Profile of the quantity available to promise'
+    _order = 'queries desc'
+
+    layer = fields.Char(readonly=True)
+    method = fields.Char(readonly=True)
+    batch_size = fields.Integer(
+        readonly=True,
+        help="Number of records computed at once, rounded down to a power "
+             "of 10")
+    calls = fields.Integer(readonly=True)
+    records = fields.Integer(readonly=True)
+    queries = fields.Integer(
+        readonly=True,
+        help="Queries, including the ones of the layers below")
+    self_queries = fields.Integer(
+        readonly=True,
+        help="Queries of this layer alone")
+    seconds = fields.Float(
+        readonly=True,
+        help="Time spent, including the layers below")
+    self_seconds = fields.Float(
+        readonly=True,
+        help="Time spent in this layer alone")
+    queries_per_record = fields.Float(readonly=True)
+
+    @api.model
+    def get_stats(self):
+        """Return the statistics of the current database.
+
+        :return: dict mapping (layer, method, batch size) to the calls,
+                 records, queries, self_queries, seconds and self_seconds
+        """
+        return {key: dict(figures) for key, figures
+                in PROFILE_STATS[self.env.cr.dbname].items()}
+
+    @api.model
+    def reset_stats(self):
+        PROFILE_STATS.pop(self.env.cr.dbname, None)
+
+    @api.model
+    def action_report(self):
+        """Generate the report of the current statistics and open it."""
+        report = self.browse()
+        for (layer, method, batch_size), figures in self.get_stats().items():
+            report |= self.create({
+                'layer': layer,
+                'method': method,
+                'batch_size': batch_size,
+                'calls': figures.get('calls', 0),
+                'records': figures.get('records', 0),
+                'queries': figures.get('queries', 0),
+                'self_queries': figures.get('self_queries', 0),
+                'seconds': figures.get('seconds', 0.0),
+                'self_seconds': figures.get('self_seconds', 0.0),
+                'queries_per_record': (
+                    float(figures.get('queries', 0)) /
+                    (figures.get('records') or 1)),
+            })
+        action = self.env.ref(
+            'stock_available.action_stock_available_profile').read()[0]
+        action['domain'] = [('id', 'in', report.ids)]
+        return action
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import models, api
+
+# Fields of the moves changing the quantity available to promise
+ATP_MOVE_FIELDS = ('product_id', 'product_uom_qty', 'product_uom', 'state',
+                   'location_id', 'location_dest_id')
+
+
+class StockMove(models.Model):
+    _inherit = 'stock.move'
+
+    @api.model
+    def create(self, vals):
+        move = super(StockMove, self).create(vals)
+        move.product_id._notify_atp_change()
+        return move
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in ATP_MOVE_FIELDS):
+            return super(StockMove, self).write(vals)
+        products = self.mapped('product_id')
+        res = super(StockMove, self).write(vals)
+        (products | self.mapped('product_id'))._notify_atp_change()
+        return res
+
+    @api.multi
+    def unlink(self):
+        products = self.mapped('product_id')
+        res = super(StockMove, self).unlink()
+        products._notify_atp_change()
+        return res
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Copyright 2014 Numérigraphe
+# Copyright 2016 Sodexis
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import models, api
+
+# Fields of the quants changing the quantity available to promise
+ATP_QUANT_FIELDS = ('product_id', 'qty', 'location_id', 'reservation_id')
+
+
+class StockQuant(models.Model):
+    _inherit = 'stock.quant'
+
+    @api.model
+    def create(self, vals):
+        quant = super(StockQuant, self).create(vals)
+        quant.product_id._notify_atp_change()
+        return quant
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in ATP_QUANT_FIELDS):
+            return super(StockQuant, self).write(vals)
+        products = self.mapped('product_id')
+        res = super(StockQuant, self).write(vals)
+        (products | self.mapped('product_id'))._notify_atp_change()
+        return res
+
+    @api.multi
+    def unlink(self):
+        products = self.mapped('product_id')
+        res = super(StockQuant, self).unlink()
+        products._notify_atp_change()
+        return res
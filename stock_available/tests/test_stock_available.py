@@ -3,8 +3,11 @@
 # Copyright 2016 Sodexis
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
 
+from ..models.profiling import batch_size_class
+
 
 class TestStockLogisticsWarehouse(TransactionCase):
 
@@ -20,3 +23,288 @@ class TestStockLogisticsWarehouse(TransactionCase):
         self.assertEquals(
             stock_setting.stock_available_mrp_based_on,
             'immediately_usable_qty')
+
+    def test_stored_immediately_usable_qty(self):
+        """The stored quantity follows the stock moves"""
+        stock_setting = self.env['stock.config.settings'].create({
+            'stock_available_stored_atp': True})
+        stock_setting.set_stock_available_stored_atp()
+
+        product = self.env['product.product'].create({
+            'name': 'Stored ATP product',
+            'type': 'product',
+        })
+        move = self.env['stock.move'].create({
+            'name': 'Receive stored ATP product',
+            'location_id': self.env.ref('stock.stock_location_suppliers').id,
+            'location_dest_id': self.env.ref('stock.stock_location_stock').id,
+            'product_id': product.id,
+            'product_uom': product.uom_id.id,
+            'product_uom_qty': 7.0,
+        })
+        move.action_confirm()
+        self.assertEquals(product.immediately_usable_qty_stored, 7.0)
+        self.assertEquals(
+            product.product_tmpl_id.immediately_usable_qty_stored, 7.0)
+        self.assertIn(product, self.env['product.product'].search(
+            [('immediately_usable_qty', '>=', 7.0)]))
+        self.assertEqual(product, self.env['product.product'].search(
+            [('id', '=', product.id)],
+            order='immediately_usable_qty_stored desc'))
+
+        move.action_cancel()
+        self.assertEquals(product.immediately_usable_qty_stored, 0.0)
+        self.assertNotIn(product, self.env['product.product'].search(
+            [('immediately_usable_qty', '>=', 7.0)]))
+        move.unlink()
+
+        quant = self.env['stock.quant'].sudo().create({
+            'product_id': product.id,
+            'location_id': self.env.ref('stock.stock_location_stock').id,
+            'qty': 3.0,
+        })
+        self.assertEquals(product.immediately_usable_qty_stored, 3.0)
+        quant.unlink()
+        self.assertEquals(product.immediately_usable_qty_stored, 0.0)
+
+    def test_stored_immediately_usable_qty_reservation(self):
+        """The stored quantity follows the reservation of the quants, even
+        when the state of the move doesn't change"""
+        stock_setting = self.env['stock.config.settings'].create({
+            'stock_available_stored_atp': True,
+            'stock_available_atp_change_log': True})
+        stock_setting.set_stock_available_stored_atp()
+        stock_setting.set_stock_available_atp_change_log()
+        self.env.user.company_id.stock_available_atp_formula = \
+            'on_hand - reserved'
+
+        product = self.env['product.product'].create({
+            'name': 'Partially reserved product',
+            'type': 'product',
+        })
+        stock = self.env.ref('stock.stock_location_stock')
+        quant = self.env['stock.quant'].sudo().create({
+            'product_id': product.id,
+            'location_id': stock.id,
+            'qty': 5.0,
+        })
+        move = self.env['stock.move'].create({
+            'name': 'Deliver partially reserved product',
+            'location_id': stock.id,
+            'location_dest_id': self.env.ref(
+                'stock.stock_location_customers').id,
+            'product_id': product.id,
+            'product_uom': product.uom_id.id,
+            'product_uom_qty': 7.0,
+        })
+        move.action_confirm()
+        self.assertEquals(product.immediately_usable_qty_stored, 5.0)
+
+        def count_changes():
+            self.env.cr.execute(
+                "SELECT COUNT(*) FROM stock_available_atp_change "
+                "WHERE product_id = %s", (product.id,))
+            return self.env.cr.fetchone()[0]
+        changes = count_changes()
+        # Reserve the quant without touching the move
+        quant.write({'reservation_id': move.id})
+        self.assertEqual('confirmed', move.state)
+        self.assertEquals(product.immediately_usable_qty_stored, 0.0)
+        self.assertGreater(count_changes(), changes)
+
+    def test_atp_formula(self):
+        """The formula of the company defines the quantity available to
+        promise"""
+        company = self.env.user.company_id
+        products = self.env['product.product'].search(
+            [('type', '=', 'product')], limit=10)
+        company.stock_available_atp_formula = 'on_hand - outgoing'
+        products.invalidate_cache()
+        for product in products:
+            self.assertAlmostEqual(
+                product.immediately_usable_qty,
+                product.qty_available - product.outgoing_qty)
+        tmpl = products[0].product_tmpl_id
+        self.assertAlmostEqual(tmpl.immediately_usable_qty,
+                               tmpl.qty_available - tmpl.outgoing_qty)
+
+        company.stock_available_atp_formula = '2 * on_hand - forecast'
+        products.invalidate_cache()
+        for product in products:
+            self.assertAlmostEqual(
+                product.immediately_usable_qty,
+                2 * product.qty_available - product.virtual_available)
+
+        with self.assertRaises(UserError):
+            company.stock_available_atp_formula = 'on_hand - unknown'
+        with self.assertRaises(UserError):
+            company.stock_available_atp_formula = 'on_hand outgoing'
+
+    def test_cached_settings(self):
+        """The cached settings follow the system parameters"""
+        settings_obj = self.env['stock.config.settings']
+        self.assertEqual(
+            settings_obj.get_stock_available_param(
+                'stock_available_mrp_based_on'),
+            'qty_available')
+        self.env['ir.config_parameter'].set_param(
+            'stock_available_mrp_based_on', 'virtual_available')
+        self.assertEqual(
+            settings_obj.get_stock_available_param(
+                'stock_available_mrp_based_on'),
+            'virtual_available')
+        stock_setting = settings_obj.create({})
+        stock_setting.stock_available_mrp_based_on = 'immediately_usable_qty'
+        stock_setting.set_stock_available_mrp_based_on()
+        self.assertEqual(
+            settings_obj.get_stock_available_param(
+                'stock_available_mrp_based_on'),
+            'immediately_usable_qty')
+
+    def test_profiling(self):
+        """The computations are profiled when enabled"""
+        profile_obj = self.env['stock.available.profile']
+        profile_obj.reset_stats()
+        products = self.env['product.product'].search([], limit=20)
+        products.mapped('immediately_usable_qty')
+        self.assertFalse(profile_obj.get_stats())
+
+        stock_setting = self.env['stock.config.settings'].create({
+            'stock_available_profiling': True})
+        stock_setting.set_stock_available_profiling()
+        products.invalidate_cache()
+        products.mapped('immediately_usable_qty')
+        stats = profile_obj.get_stats()
+        key = ('stock_available',
+               'product.product._compute_immediately_usable_qty',
+               batch_size_class(len(products)))
+        self.assertIn(key, stats)
+        self.assertEqual(stats[key]['records'], len(products))
+        self.assertGreaterEqual(stats[key]['queries'],
+                                stats[key]['self_queries'])
+
+        action = profile_obj.action_report()
+        report = profile_obj.search(action['domain'])
+        self.assertEqual(len(report), len(stats))
+        profile_obj.reset_stats()
+
+    def test_atp_projection(self):
+        """The projection follows the expected dates of the moves"""
+        product = self.env['product.product'].create({
+            'name': 'Projected ATP product',
+            'type': 'product',
+        })
+        stock = self.env.ref('stock.stock_location_stock')
+        for qty, source, dest, date in (
+                (7.0, self.env.ref('stock.stock_location_suppliers'), stock,
+                 '2030-01-09 12:00:00'),
+                (3.0, stock, self.env.ref('stock.stock_location_customers'),
+                 '2030-01-16 12:00:00'),
+                (1.0, stock, self.env.ref('stock.stock_location_customers'),
+                 '2029-12-31 12:00:00')):
+            self.env['stock.move'].create({
+                'name': 'Move projected ATP product',
+                'location_id': source.id,
+                'location_dest_id': dest.id,
+                'product_id': product.id,
+                'product_uom': product.uom_id.id,
+                'product_uom_qty': qty,
+                'date_expected': date,
+            }).action_confirm()
+
+        company = self.env.user.company_id
+        company.stock_available_atp_formula = 'on_hand'
+        curve = product.get_atp_projection(
+            '2030-01-07', '2030-01-20')[product.id]
+        self.assertEqual(len(curve), 14)
+        self.assertEqual(curve[0], ('2030-01-07', -1.0))
+        self.assertEqual(curve[2], ('2030-01-09', 6.0))
+        self.assertEqual(curve[9], ('2030-01-16', 3.0))
+        self.assertEqual(curve[-1][1], product.virtual_available)
+
+        curve = product.get_atp_projection(
+            '2030-01-07', '2030-01-20', 'week')[product.id]
+        self.assertEqual(curve, [('2030-01-07', 6.0), ('2030-01-14', 3.0)])
+
+        # The projection starts from the current quantity available to
+        # promise, and the deliveries are already subtracted from it
+        company.stock_available_atp_formula = 'on_hand - outgoing'
+        product.invalidate_cache()
+        curve = product.get_atp_projection(
+            '2030-01-07', '2030-01-20')[product.id]
+        self.assertEqual(curve[0][1], product.immediately_usable_qty)
+        self.assertEqual(curve[2][1], product.immediately_usable_qty + 7.0)
+        self.assertEqual(curve[-1][1], curve[2][1])
+
+        with self.assertRaises(UserError):
+            product.get_atp_projection(interval='year')
+
+    def test_atp_export(self):
+        """The export computes the storable products chunk by chunk"""
+        product_obj = self.env['product.product']
+        storable = product_obj.search([('type', '=', 'product')])
+        chunks = list(product_obj._iter_atp_export(chunk_size=3))
+        self.assertEqual(len(chunks), -(-len(storable) // 3))
+        rows = [row for chunk in chunks for row in chunk]
+        self.assertEqual({row[0] for row in rows}, set(storable.ids))
+        for product_id, _code, location_id, qty in rows:
+            self.assertFalse(location_id)
+            self.assertEqual(
+                qty, product_obj.browse(product_id).immediately_usable_qty)
+
+        stock = self.env.ref('stock.stock_location_stock')
+        rows = next(product_obj._iter_atp_export(location_ids=[stock.id]))
+        self.assertTrue(all(row[2] == stock.id for row in rows))
+
+        # Delta mode: only the products changed since the watermark
+        change_obj = self.env['stock.available.atp.change']
+        self.assertIsNone(change_obj.get_watermark())
+        with self.assertRaises(UserError):
+            list(product_obj._iter_atp_export(since=0))
+        stock_setting = self.env['stock.config.settings'].create({
+            'stock_available_atp_change_log': True})
+        stock_setting.set_stock_available_atp_change_log()
+        with self.assertRaises(UserError):
+            # Taken before the log was enabled
+            list(product_obj._iter_atp_export(since=0))
+        watermark = change_obj.get_watermark()
+        product = product_obj.create({
+            'name': 'Exported ATP product',
+            'type': 'product',
+        })
+        deleted = product_obj.create({
+            'name': 'Deleted ATP product',
+            'type': 'product',
+        })
+        deleted_id = deleted.id
+        deleted.unlink()
+        rows = {row[0]: row
+                for chunk in product_obj._iter_atp_export(since=watermark)
+                for row in chunk}
+        self.assertIn(product.id, rows)
+        self.assertEqual(rows[deleted_id], (deleted_id, False, False, 0.0))
+        self.assertFalse(set(storable.ids) & set(rows))
+
+    def test_atp_matrix(self):
+        """The matrix gives the same quantities as each warehouse alone"""
+        products = self.env['product.product'].search(
+            [('type', '=', 'product')], limit=20)
+        warehouses = self.env['stock.warehouse'].search([])
+        matrix = products.get_atp_matrix()
+        for warehouse in warehouses:
+            for product in products.with_context(warehouse=warehouse.id):
+                self.assertAlmostEqual(
+                    matrix[product.id][warehouse.id],
+                    product.immediately_usable_qty,
+                    msg="Wrong ATP for %s in %s" % (
+                        product.name, warehouse.name))
+
+        self.env.user.company_id.stock_available_atp_formula = \
+            'on_hand - reserved'
+        warehouse = warehouses[0]
+        matrix = products.get_atp_matrix([warehouse.id])
+        for product in products.with_context(warehouse=warehouse.id):
+            self.assertAlmostEqual(
+                matrix[product.id][warehouse.id],
+                product.qty_available -
+                product._get_atp_reserved_qty()[product.id])
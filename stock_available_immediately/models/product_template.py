@@ -4,17 +4,28 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
 from odoo import models, api
+from odoo.addons.stock_available.models.profiling import profiled
 
 
 class ProductTemplate(models.Model):
     _inherit = 'product.template'
 
     @api.multi
-    @api.depends('virtual_available', 'incoming_qty')
-    def _compute_immediately_usable_qty(self):
+    @profiled('stock_available_immediately')
+    def _get_immediately_usable_base_qty(self):
         """Ignore the incoming goods in the quantity available to promise
 
+        The quantities of all the variants are computed at once.
         This is the same implementation as for variants."""
-        super(ProductTemplate, self)._compute_immediately_usable_qty()
-        for tmpl in self:
-            tmpl.immediately_usable_qty -= tmpl.incoming_qty
+        if not all(self.ids):
+            res = super(ProductTemplate, self).\
+                _get_immediately_usable_base_qty()
+            return {tmpl.id: res[tmpl.id] - tmpl.incoming_qty
+                    for tmpl in self}
+        variant_qties = self.mapped('product_variant_ids').\
+            _get_immediately_usable_base_qty()
+        return {
+            tmpl.id: sum(variant_qties[variant.id]
+                         for variant in tmpl.product_variant_ids)
+            for tmpl in self
+        }
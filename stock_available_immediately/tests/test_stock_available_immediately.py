@@ -108,3 +108,39 @@ the variations in stock, both on product and template"""
         # Potential Qty is set as 0.0 by default
         self.assertEquals(templateAB.potential_qty, 0.0)
         self.assertEquals(productA.potential_qty, 0.0)
+
+    def test02_single_query_matches_core_quantities(self):
+        """The quantity computed in a single query matches the forecasted
+        quantity without the incoming goods, in any location"""
+        stock_location = self.env.ref('stock.stock_location_stock')
+        shelf_location = self.env.ref('stock.stock_location_components')
+        products = self.env['product.product'].search(
+            [('type', '=', 'product')], limit=20)
+        for context in ({},
+                        {'location': stock_location.id},
+                        {'location': shelf_location.id},
+                        {'warehouse': self.env.ref('stock.warehouse0').id}):
+            products.invalidate_cache()
+            for product in products.with_context(context):
+                self.assertAlmostEqual(
+                    product.immediately_usable_qty,
+                    product.virtual_available - product.incoming_qty)
+            templates = products.mapped('product_tmpl_id')
+            for tmpl in templates.with_context(context):
+                self.assertAlmostEqual(
+                    tmpl.immediately_usable_qty,
+                    tmpl.virtual_available - tmpl.incoming_qty)
+
+    def test03_matrix_default_plan(self):
+        """The default plan of the matrix cancels the incoming goods and
+        keeps the terms of the other modules"""
+        plan = self.env['product.product']._get_atp_matrix_default_plan()
+        self.assertIn((1.0, 'forecast'), plan)
+        self.assertIn((-1.0, 'incoming'), plan)
+        modules = self.env['ir.module.module'].search(
+            [('name', 'in', ('stock_available_mrp', 'stock_available_sale')),
+             ('state', '=', 'installed')]).mapped('name')
+        if 'stock_available_mrp' in modules:
+            self.assertIn((1.0, 'potential'), plan)
+        if 'stock_available_sale' in modules:
+            self.assertIn((-1.0, 'quoted'), plan)
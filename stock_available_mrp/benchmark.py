@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# © 2014 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+"""Benchmark of the quantity available to promise and the potential qty.
+
+This module is not loaded with the addon. Run it from an Odoo shell on a
+disposable database, for example::
+
+    from openerp.addons.stock_available_mrp.benchmark import run_benchmark
+    print run_benchmark(env, sizes=(1, 100, 10000), output='bench.json')
+    env.cr.rollback()
+
+A synthetic catalogue is generated: finished products with variants, made
+of sub-assemblies down to a configurable depth, with the raw materials in
+stock in several locations. The quantities of a growing number of finished
+products are then computed, and the number of queries, wall time and growth
+of the peak memory of the process of each computation are reported as JSON.
+"""
+
+import json
+import logging
+import resource
+import time
+
+_logger = logging.getLogger(__name__)
+
+MEASURED_FIELDS = ('potential_qty', 'immediately_usable_qty')
+
+
+def generate_catalogue(env, products=100, variants=4, depth=1, width=3,
+                       locations=2):
+    """Create a synthetic catalogue of manufactured products.
+
+    :param products: minimum number of finished products (variants)
+    :param variants: number of variants of each finished template
+    :param depth: number of levels of BoMs; below the first level the
+                  sub-assemblies are kits (phantom BoMs)
+    :param width: number of lines of each BoM
+    :param locations: number of stock locations holding the raw materials
+    :return: recordset of the finished products
+    """
+    product_model = env['product.product']
+    bom_model = env['mrp.bom']
+    stock = env.ref('stock.stock_location_stock')
+    quant_model = env['stock.quant'].sudo()
+    tag = 'bench-%d' % (time.time() * 1000)
+
+    location_ids = [
+        env['stock.location'].create({
+            'name': '%s location %d' % (tag, i),
+            'location_id': stock.id,
+            'usage': 'internal'}).id
+        for i in range(locations)]
+
+    # Raw materials, in stock in every location
+    level = product_model.browse()
+    for i in range(width):
+        material = product_model.create({'name': '%s material %d' % (tag, i),
+                                         'type': 'product'})
+        for j, location_id in enumerate(location_ids):
+            quant_model.create({'product_id': material.id,
+                                'location_id': location_id,
+                                'qty': 1000.0 * (i + j + 1)})
+        level |= material
+
+    # Kits, from the bottom up
+    for depth_index in range(depth - 1, 0, -1):
+        kits = product_model.browse()
+        for i in range(width):
+            kit = product_model.create({
+                'name': '%s kit %d.%d' % (tag, depth_index, i),
+                'type': 'product'})
+            _create_bom(bom_model, kit.product_tmpl_id, level, 'phantom')
+            kits |= kit
+        level = kits
+
+    # Finished products with variants
+    attribute = env['product.attribute'].create({'name': tag})
+    value_ids = [
+        env['product.attribute.value'].create({
+            'name': '%s value %d' % (tag, i),
+            'attribute_id': attribute.id}).id
+        for i in range(variants)]
+    finished = product_model.browse()
+    for i in range(-(-products // variants)):
+        template = env['product.template'].create({
+            'name': '%s product %d' % (tag, i),
+            'type': 'product',
+            'attribute_line_ids': [(0, 0, {
+                'attribute_id': attribute.id,
+                'value_ids': [(6, 0, value_ids)]})]})
+        _create_bom(bom_model, template, level, 'normal')
+        finished |= template.product_variant_ids
+    _logger.info('Generated a catalogue of %d products', len(finished))
+    return finished
+
+
+def _create_bom(bom_model, template, components, bom_type):
+    return bom_model.create({
+        'product_tmpl_id': template.id,
+        'product_qty': 1.0,
+        'type': bom_type,
+        'bom_line_ids': [(0, 0, {'product_id': component.id,
+                                 'product_qty': i + 1.0})
+                         for i, component in enumerate(components)]})
+
+
+def measure(records, field_name):
+    """Compute a field on a recordset, with cold caches.
+
+    The memory is reported as the new process peak: the growth of the
+    maximum resident set size of the process, which is 0 unless this
+    computation reaches a new peak. It is not the memory used by the
+    computation: the computations can't run in a forked process, as they
+    read the catalogue created in the uncommitted transaction of the
+    current connection.
+
+    :return: dict of the number of queries, seconds and kilobytes of new
+             process peak
+    """
+    env = records.env
+    records.invalidate_cache()
+    records.clear_caches()
+    cr = env.cr
+    queries = cr.sql_log_count
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    records.mapped(field_name)
+    return {
+        'field': field_name,
+        'model': records._name,
+        'size': len(records),
+        'queries': cr.sql_log_count - queries,
+        'seconds': round(time.time() - start, 6),
+        'new_process_peak_kb': (resource.getrusage(resource.RUSAGE_SELF)
+                                .ru_maxrss - rss),
+    }
+
+
+def run_benchmark(env, sizes=(1, 100, 10000), variants=4, depth=1, width=3,
+                  locations=2, output=None):
+    """Generate a catalogue and measure the quantities of growing subsets.
+
+    The data is created in the current transaction: roll it back afterwards.
+
+    :param sizes: numbers of products to compute at once
+    :param output: optional path of a file to write the JSON results to
+    :return: the results, as a JSON string
+    """
+    parameters = {'sizes': list(sizes), 'variants': variants,
+                  'depth': depth, 'width': width, 'locations': locations}
+    products = generate_catalogue(env, max(sizes), variants, depth, width,
+                                  locations)
+    results = []
+    for size in sizes:
+        for field_name in MEASURED_FIELDS:
+            results.append(measure(products[:size], field_name))
+    report = json.dumps({'parameters': parameters, 'results': results},
+                        indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as report_file:
+            report_file.write(report)
+    return report
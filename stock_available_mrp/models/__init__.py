@@ -4,3 +4,5 @@
 
 from . import product_product
 from . import product_template
+from . import mrp_bom
+from . import product_uom
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# © 2014 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from openerp import models, api
+
+
+class MrpBom(models.Model):
+    _inherit = 'mrp.bom'
+
+    @api.multi
+    def _get_bom_products(self):
+        """Return the products made with the BoMs"""
+        products = self.env['product.product']
+        for bom in self:
+            products |= (bom.product_id or
+                         bom.product_tmpl_id.product_variant_ids)
+        return products
+
+    @api.model
+    def create(self, vals):
+        # The component needs depend on the BoMs
+        self.env['product.product'].clear_caches()
+        bom = super(MrpBom, self).create(vals)
+        bom._get_bom_products()._notify_atp_change()
+        return bom
+
+    @api.multi
+    def write(self, vals):
+        self.env['product.product'].clear_caches()
+        products = self._get_bom_products()
+        res = super(MrpBom, self).write(vals)
+        (products | self._get_bom_products())._notify_atp_change()
+        return res
+
+    @api.multi
+    def unlink(self):
+        self.env['product.product'].clear_caches()
+        products = self._get_bom_products()
+        res = super(MrpBom, self).unlink()
+        products._notify_atp_change()
+        return res
+
+
+class MrpBomLine(models.Model):
+    _inherit = 'mrp.bom.line'
+
+    @api.model
+    def create(self, vals):
+        # The component needs depend on the BoM lines
+        self.env['product.product'].clear_caches()
+        line = super(MrpBomLine, self).create(vals)
+        line.bom_id._get_bom_products()._notify_atp_change()
+        return line
+
+    @api.multi
+    def write(self, vals):
+        self.env['product.product'].clear_caches()
+        boms = self.mapped('bom_id')
+        res = super(MrpBomLine, self).write(vals)
+        (boms | self.mapped('bom_id'))._get_bom_products().\
+            _notify_atp_change()
+        return res
+
+    @api.multi
+    def unlink(self):
+        self.env['product.product'].clear_caches()
+        products = self.mapped('bom_id')._get_bom_products()
+        res = super(MrpBomLine, self).unlink()
+        products._notify_atp_change()
+        return res
@@ -2,12 +2,26 @@
 # © 2014 Numérigraphe SARL
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from collections import Counter
+import logging
+import time
+from collections import Counter, defaultdict
 
-from openerp import models, fields, api
+from openerp import models, fields, api, tools, _
 from openerp.addons import decimal_precision as dp
+from openerp.addons.stock_available.models.profiling import profiled
+from openerp.tools import DEFAULT_SERVER_DATE_FORMAT
 
-from openerp.exceptions import AccessError
+from openerp.exceptions import AccessError, UserError
+
+from ..potential_matrix import np, min_floor_division
+
+_logger = logging.getLogger(__name__)
+
+# Below this number of products, plain python is faster than NumPy
+VECTORIZE_MIN_PRODUCTS = 1000
+
+# Hit/miss counters of the component needs cache, per database
+NEEDS_CACHE_STATS = defaultdict(Counter)
 
 
 class ProductProduct(models.Model):
@@ -21,65 +35,491 @@ class ProductProduct(models.Model):
         help="Quantity of this Product that could be produced using "
              "the materials already at hand.")
 
-    # Needed for fields dependencies
-    # When self.potential_qty is compute, we want to force the ORM
-    # to compute all the components potential_qty too.
     component_ids = fields.Many2many(
         comodel_name='product.product',
         compute='_get_component_ids',
     )
 
+    @api.multi
+    def write(self, vals):
+        if 'attribute_value_ids' in vals:
+            # The BoM lines used depend on the attributes of the variant
+            self.clear_caches()
+        return super(ProductProduct, self).write(vals)
+
     @api.multi
     @api.depends('potential_qty')
+    @profiled('stock_available_mrp')
     def _immediately_usable_qty(self):
         """Add the potential quantity to the quantity available to promise.
 
         This is the same implementation as for templates."""
         super(ProductProduct, self)._immediately_usable_qty()
+        if self.env['product.product']._get_atp_plan():
+            # The formula decides by itself whether the potential is added
+            return
         for product in self:
             product.immediately_usable_qty += product.potential_qty
 
+    @api.model
+    def _get_atp_matrix_default_plan(self):
+        """Add the potential quantity in the matrix too"""
+        return super(ProductProduct, self)._get_atp_matrix_default_plan() + (
+            (1.0, 'potential'),)
+
+    @api.model
+    def _get_bom_parent_ids(self, product_ids):
+        """Return the products made of some products, level by level up to
+        the finished products
+
+        :param product_ids: set of ids of the components
+        :return: set of ids of the products using them, excluding them
+        """
+        cr = self.env.cr
+        parent_ids = set()
+        frontier = set(product_ids)
+        while frontier:
+            cr.execute("""
+                SELECT product_product.id
+                FROM mrp_bom
+                INNER JOIN product_product
+                     ON (product_product.product_tmpl_id =
+                         mrp_bom.product_tmpl_id
+                         AND (mrp_bom.product_id IS NULL
+                              OR mrp_bom.product_id = product_product.id))
+                INNER JOIN mrp_bom_line ON (mrp_bom_line.bom_id = mrp_bom.id)
+                WHERE mrp_bom_line.product_id IN %s
+                """, (tuple(frontier),))
+            frontier = ({row[0] for row in cr.fetchall()} - parent_ids -
+                        set(product_ids))
+            parent_ids |= frontier
+        return parent_ids
+
+    @api.multi
+    def _get_atp_dependent_products(self):
+        """Add the products made of these products, whose potential
+        quantity depends on their stock"""
+        products = super(ProductProduct, self)._get_atp_dependent_products()
+        return products | self.browse(
+            list(self._get_bom_parent_ids(set(self.ids))))
+
     @api.multi
-    @api.depends('component_ids.potential_qty')
+    @api.depends()
+    @profiled('stock_available_mrp')
     def _get_potential_qty(self):
         """Compute the potential qty based on the available components."""
-        bom_obj = self.env['mrp.bom']
-        uom_obj = self.env['product.uom']
+        if self.env.context.get('skip_potential_qty'):
+            # Stock of the sub-assemblies, without their own potential
+            for product in self:
+                product.potential_qty = 0.0
+            return
+        potentials = self._compute_potential_qties()
+        for product in self:
+            product.potential_qty = potentials.get(product.id, 0.0)
+
+    @api.multi
+    def _compute_potential_qties(self):
+        """ Compute the potential qty of the products of the recordset.
+
+        The BoMs, their explosion and the stock of the components are
+        fetched for the whole recordset at once.
+        When the stock of the components includes their own potential, the
+        sub-assemblies are added to the graph of components level by level,
+        and each node of the graph is evaluated once, components first.
+        Cycles in the graph are logged and don't add any potential.
+
+        :return: dict mapping product ids to their potential qty
+        """
+        multi_level = self._is_potential_multi_level()
+
+        # Build the graph of components: product id -> (bom, needs)
+        graph = {}
+        visited = set(self.ids)
+        frontier = self
+        while frontier:
+            product_boms = frontier._get_boms()
+            needs = self._get_components_needs_batch(product_boms)
+            next_ids = set()
+            for product, component_needs in needs.items():
+                if not component_needs:
+                    # The BoM has no line we can use
+                    continue
+                graph[product.id] = (
+                    product_boms[product],
+                    {c.id: need for c, need in component_needs.items()})
+                next_ids.update(c.id for c in component_needs)
+            if not multi_level:
+                break
+            frontier = self.browse(list(next_ids - visited))
+            visited |= next_ids
+
+        component_ids = set()
+        for _bom, component_needs in graph.values():
+            component_ids.update(component_needs)
+        components = self.browse(list(component_ids))
+        if multi_level:
+            components = components.with_context(skip_potential_qty=True)
+        component_qties = self._get_components_qty(components)
+
+        if not multi_level and self._use_vectorized_potential(len(graph)):
+            return self._evaluate_potential_vectorized(graph, component_qties)
+
+        potentials = {}
+        cycles = []
+
+        def evaluate(product_id, path):
+            if product_id in potentials:
+                return potentials[product_id]
+            if product_id in path:
+                cycles.append(path[path.index(product_id):] + [product_id])
+                return 0.0
+            if product_id not in graph:
+                potentials[product_id] = 0.0
+                return 0.0
+            bom, component_needs = graph[product_id]
+            path.append(product_id)
+            qties = []
+            for component_id, need in component_needs.items():
+                qty = component_qties[component_id]
+                if multi_level:
+                    qty += evaluate(component_id, path)
+                qties.append(qty // need)
+            path.pop()
+            # Find the lowest quantity we can make with the stock at hand
+            potentials[product_id] = self._get_bom_qty(bom) * min(qties)
+            return potentials[product_id]
 
         for product in self:
-            bom_id = bom_obj._bom_find(product_id=product.id)
-            if not bom_id:
-                product.potential_qty = 0.0
+            evaluate(product.id, [])
+
+        for cycle in cycles:
+            _logger.warning(
+                "Cycle in the bills of materials, the potential of the "
+                "sub-assemblies is ignored: %s",
+                " -> ".join(self.browse(cycle).mapped('display_name')))
+        return potentials
+
+    @api.model
+    def _use_vectorized_potential(self, size):
+        """ Tell whether the potential of *size* products should be computed
+        with NumPy rather than in plain python.
+
+        The context key `vectorize_potential_qty` forces the choice.
+        """
+        vectorize = self.env.context.get('vectorize_potential_qty')
+        if vectorize is not None:
+            return bool(vectorize) and np is not None
+        return np is not None and size >= VECTORIZE_MIN_PRODUCTS
+
+    @api.model
+    def _evaluate_potential_vectorized(self, graph, component_qties):
+        """ Compute the potential of all the products of *graph* at once,
+        with a sparse matrix of the needs and a vector of the stock.
+
+        The results are identical to the plain python computation.
+
+        :param graph: dict mapping product ids to (bom, needs) pairs
+        :param component_qties: dict mapping component ids to their stock
+        :return: dict mapping product ids to their potential qty
+        """
+        product_ids = list(graph)
+        component_ids = list(component_qties)
+        rows, columns, needs = self._get_needs_coo(
+            product_ids,
+            {product_id: graph[product_id][1] for product_id in product_ids},
+            component_ids)
+        stock = np.array([component_qties[component_id]
+                          for component_id in component_ids], dtype=float)
+        bom_qties = np.array([self._get_bom_qty(graph[product_id][0])
+                              for product_id in product_ids], dtype=float)
+        runs = min_floor_division(rows, columns, needs, stock,
+                                  len(product_ids))
+        potentials = dict.fromkeys(self.ids, 0.0)
+        potentials.update(zip(product_ids, (bom_qties * runs).tolist()))
+        return potentials
+
+    @api.model
+    def _get_needs_coo(self, product_ids, product_needs, component_ids):
+        """ Flatten the needs of some products in coordinate format
+
+        :param product_ids: ids of the products, in the order of the rows
+        :param product_needs: dict mapping the product ids to dicts mapping
+                              the ids of their components to their needs
+        :param component_ids: ids of the components, in the order of the
+                              columns
+        :return: (rows, columns, needs) arrays, one entry per need
+        """
+        column = {component_id: i for i, component_id in
+                  enumerate(component_ids)}
+        rows, columns, needs = [], [], []
+        for row, product_id in enumerate(product_ids):
+            for component_id, need in product_needs[product_id].items():
+                rows.append(row)
+                columns.append(column[component_id])
+                needs.append(need)
+        return (np.array(rows, dtype=int), np.array(columns, dtype=int),
+                np.array(needs, dtype=float))
+
+    @api.model
+    def _is_potential_multi_level(self):
+        """ Tell whether the stock used for the components includes their
+        own potential, in which case the sub-assemblies must be evaluated
+        before the products using them.
+        """
+        field = self._fields[self._get_potential_based_on()]
+        return (field.name == 'potential_qty' or
+                'potential_qty' in (field.depends or ()))
+
+    @api.multi
+    def _get_boms(self):
+        """ Find the BoM of each product of the recordset in a single search.
+
+        The BoM chosen for each product is the one `mrp.bom._bom_find`
+        would return for it, without properties.
+
+        :rtype: dict mapping product_product to mrp_bom
+        """
+        if not self:
+            return {}
+        today = time.strftime(DEFAULT_SERVER_DATE_FORMAT)
+        templates = self.mapped('product_tmpl_id')
+        domain = ['|', ('product_id', 'in', self.ids),
+                  '&', ('product_id', '=', False),
+                  ('product_tmpl_id', 'in', templates.ids)]
+        if self.env.context.get('company_id'):
+            domain += [('company_id', '=', self.env.context['company_id'])]
+        domain += ['|', ('date_start', '=', False),
+                   ('date_start', '<=', today),
+                   '|', ('date_stop', '=', False),
+                   ('date_stop', '>=', today)]
+        # order to prioritize bom with product_id over the one without
+        boms = self.env['mrp.bom'].search(domain, order='sequence, product_id')
+
+        # Keep the first BoM without properties for each variant/template
+        variant_boms = {}
+        template_boms = {}
+        for bom in boms:
+            if bom.property_ids:
+                continue
+            if bom.product_id:
+                variant_boms.setdefault(bom.product_id.id, bom)
+            else:
+                template_boms.setdefault(bom.product_tmpl_id.id, bom)
+        rank = {bom.id: index for index, bom in enumerate(boms)}
+
+        res = {}
+        for product in self:
+            candidates = [
+                bom for bom in (variant_boms.get(product.id),
+                                template_boms.get(product.product_tmpl_id.id))
+                if bom]
+            if candidates:
+                res[product] = min(candidates, key=lambda b: rank[b.id])
+        return res
+
+    @api.model
+    def _get_components_needs_batch(self, product_boms):
+        """ Return the needed qty of each component for several products.
+
+        The needs are cached per product and BoM, see
+        `_get_cached_components_needs`.
+        Products whose BoM the user is not allowed to explode are left out.
+
+        :param product_boms: dict mapping product_product to mrp_bom
+        :rtype: dict mapping product_product to collections.Counter
+        """
+        # The BoMs found depend on the company and on their validity dates
+        company_id = self.env.context.get('company_id')
+        today = time.strftime(DEFAULT_SERVER_DATE_FORMAT)
+        keys = {product: (product.id, bom.id, company_id, today)
+                for product, bom in product_boms.items()}
+
+        stats = NEEDS_CACHE_STATS[self.env.cr.dbname]
+        misses = stats['miss']
+        cached_needs = self._get_cached_components_needs(
+            list(set(keys.values())))
+        stats['hit'] += len(set(keys.values())) - (stats['miss'] - misses)
+
+        res = {}
+        for product, key in keys.items():
+            if cached_needs[key] is None:
                 continue
+            res[product] = Counter({
+                self.browse(component_id): qty
+                for component_id, qty in cached_needs[key]
+            })
+        return res
+
+    @api.model
+    @tools.ormcache_multi('self._uid', multi='keys')
+    def _get_cached_components_needs(self, keys):
+        """ Explode the BoMs and normalize the needs to the components' UoM.
+
+        The phantom BoMs met while exploding are resolved level by level for
+        all the products at once.
+        The result is cached until a BoM, a BoM line or a UoM is modified.
+
+        :param keys: list of (product id, bom id, company id, date) tuples
+        :return: dict mapping each key to a tuple of (component id, qty)
+                 pairs, or to None if the user may not explode the BoM
+        """
+        NEEDS_CACHE_STATS[self.env.cr.dbname]['miss'] += len(keys)
+        product_boms = {
+            self.browse(product_id): self.env['mrp.bom'].browse(bom_id)
+            for product_id, bom_id, _company_id, _date in keys
+        }
+        bom_map = dict(product_boms)
+        boms = product_boms.values()
+        while boms:
+            to_resolve = self.browse()
+            for bom in boms:
+                to_resolve |= bom.bom_line_ids.mapped('product_id')
+            to_resolve = to_resolve.filtered(lambda p: p not in bom_map)
+            sub_boms = to_resolve._get_boms()
+            bom_map.update(dict.fromkeys(to_resolve, False))
+            bom_map.update(sub_boms)
+            # Only the sets (phantom BoMs) are exploded further
+            boms = [bom for bom in sub_boms.values() if bom.type == 'phantom']
 
-            bom = bom_obj.browse(bom_id)
+        routing_readable = self.env['mrp.routing'].check_access_rights(
+            'read', raise_exception=False)
 
-            # Need by product (same product can be in many BOM lines/levels)
+        res = {}
+        for key in keys:
+            product = self.browse(key[0])
             try:
-                component_needs = self._get_components_needs(product, bom)
+                exploded = self._explode_bom(
+                    product_boms[product], product, 1.0, bom_map,
+                    routing_readable)
             except AccessError:
                 # If user doesn't have access to BOM
                 # he can't see potential_qty
-                component_needs = None
+                res[key] = None
+                continue
+            needs = Counter()
+            for component, qty, uom in exploded:
+                needs += Counter({
+                    component.id: self._convert_component_qty(
+                        component, qty, uom)
+                })
+            res[key] = tuple(needs.items())
+        return res
 
-            if not component_needs:
-                # The BoM has no line we can use
-                product.potential_qty = 0.0
+    @api.model
+    def get_components_needs_cache_stats(self):
+        """ Return the hit and miss counters of the component needs cache
+        for the current database.
+
+        :rtype: dict
+        """
+        return dict(NEEDS_CACHE_STATS[self.env.cr.dbname])
+
+    @api.model
+    def _explode_bom(self, bom, product, factor, bom_map, routing_readable,
+                     previous_products=None, master_bom=None):
+        """ Explode *bom* like `mrp.bom._bom_explode` does for the products,
+        using the BoMs already resolved in *bom_map*.
+
+        :rtype: list of (product_product, qty, product_uom) tuples
+        """
+        bom_obj = self.env['mrp.bom']
+        uom_obj = self.env['product.uom']
+        master_bom = master_bom or bom
+
+        def _factor(factor, product_efficiency, product_rounding):
+            factor = factor / (product_efficiency or 1.0)
+            if product_rounding:
+                factor = tools.float_round(factor,
+                                           precision_rounding=product_rounding,
+                                           rounding_method='UP')
+            if factor < product_rounding:
+                factor = product_rounding
+            return factor
+
+        if bom.routing_id and not routing_readable:
+            raise AccessError(_("You are not allowed to read the routing "
+                                "of the BoM %s.") % bom.display_name)
 
+        factor = _factor(factor, bom.product_efficiency, bom.product_rounding)
+        result = []
+        for line in bom.bom_line_ids:
+            if bom_obj._skip_bom_line(line, product):
+                continue
+            if line.property_ids:
+                continue
+            component = line.product_id
+            if (previous_products and
+                    component.product_tmpl_id.id in previous_products):
+                raise UserError(
+                    _('BoM "%s" contains a BoM line with a product '
+                      'recursion: "%s".') % (master_bom.code or "",
+                                             component.display_name))
+
+            quantity = _factor(line.product_qty * factor,
+                               line.product_efficiency,
+                               line.product_rounding)
+            if component not in bom_map:
+                bom_map[component] = component._get_boms().get(component)
+            sub_bom = bom_map[component]
+
+            # If BoM should not behave like kit, just add the product,
+            # otherwise explode further
+            if (line.type != 'phantom' and
+                    (not sub_bom or sub_bom.type != 'phantom')):
+                result.append((component, quantity, line.product_uom))
+            elif sub_bom:
+                all_prod = [bom.product_tmpl_id.id] + (previous_products or [])
+                # We need to convert to units/UoM of chosen BoM
+                factor2 = uom_obj._compute_qty_obj(
+                    line.product_uom, quantity, sub_bom.product_uom)
+                quantity2 = factor2 / sub_bom.product_qty
+                result += self._explode_bom(
+                    sub_bom, component, quantity2, bom_map, routing_readable,
+                    previous_products=all_prod, master_bom=master_bom)
             else:
-                # Find the lowest quantity we can make with the stock at hand
-                components_potential_qty = min(
-                    [self._get_component_qty(component) // need
-                     for component, need in component_needs.items()]
-                )
-
-                # Compute with bom quantity
-                bom_qty = uom_obj._compute_qty_obj(
-                    bom.product_uom,
-                    bom.product_qty,
-                    bom.product_tmpl_id.uom_id
-                )
-                product.potential_qty = bom_qty * components_potential_qty
+                raise UserError(
+                    _('BoM "%s" contains a phantom BoM line but the product '
+                      '"%s" does not have any BoM defined.') % (
+                        master_bom.code or "", component.display_name))
+        return result
+
+    @api.model
+    def _convert_component_qty(self, component, qty, uom):
+        """ Convert a quantity of *component* to its default UoM. """
+        return self.env['product.uom']._compute_qty_obj(
+            uom, qty, component.uom_id)
+
+    @api.model
+    def _get_bom_qty(self, bom):
+        """ Return the quantity made by *bom* in the product's UoM. """
+        return self.env['product.uom']._compute_qty_obj(
+            bom.product_uom,
+            bom.product_qty,
+            bom.product_tmpl_id.uom_id
+        )
+
+    @api.model
+    def _get_components_qty(self, components):
+        """ Return the qty of several components, based on company settings.
+
+        The stock field is read for all the components at once.
+
+        :type components: product_product
+        :rtype: dict mapping the component ids to their qty
+        """
+        stock_available_mrp_based_on = self._get_potential_based_on()
+        return {component.id: component[stock_available_mrp_based_on]
+                for component in components}
+
+    @api.model
+    def _get_potential_based_on(self):
+        """ Return the name of the field giving the stock of components.
+
+        The setting is cached by `stock.config.settings`, so it is only read
+        from the database when it changes.
+        """
+        return self.env['stock.config.settings'].get_stock_available_param(
+            'stock_available_mrp_based_on')
 
     def _get_component_qty(self, component):
         """ Return the component qty to use based en company settings.
@@ -87,12 +527,7 @@ class ProductProduct(models.Model):
         :type component: product_product
         :rtype: float
         """
-        icp = self.env['ir.config_parameter']
-        stock_available_mrp_based_on = icp.get_param(
-            'stock_available_mrp_based_on', 'qty_available'
-        )
-
-        return component[stock_available_mrp_based_on]
+        return self._get_components_qty(component)[component.id]
 
     def _get_components_needs(self, product, bom):
         """ Return the needed qty of each compoments in the *bom* of *product*.
@@ -101,34 +536,15 @@ class ProductProduct(models.Model):
         :type bom: mrp_bom
         :rtype: collections.Counter
         """
-        bom_obj = self.env['mrp.bom']
-        uom_obj = self.env['product.uom']
-        product_obj = self.env['product.product']
-
-        needs = Counter()
-        for bom_component in bom_obj._bom_explode(bom, product, 1.0)[0]:
-            product_uom = uom_obj.browse(bom_component['product_uom'])
-            component = product_obj.browse(bom_component['product_id'])
-
-            component_qty = uom_obj._compute_qty_obj(
-                product_uom,
-                bom_component['product_qty'],
-                component.uom_id,
-            )
-            needs += Counter(
-                {component: component_qty}
-            )
-
-        return needs
+        return self._get_components_needs_batch({product: bom}).get(
+            product, Counter())
 
     def _get_component_ids(self):
         """ Compute component_ids by getting all the components for
         this product.
         """
-        bom_obj = self.env['mrp.bom']
-
-        bom_id = bom_obj._bom_find(product_id=self.id)
-        if bom_id:
-            bom = bom_obj.browse(bom_id)
-            for bom_component in bom_obj._bom_explode(bom, self, 1.0)[0]:
-                self.component_ids |= self.browse(bom_component['product_id'])
+        bom = self._get_boms().get(self)
+        if bom:
+            needs = self._get_components_needs(self, bom)
+            self.component_ids = self.browse(
+                [component.id for component in needs])
@@ -2,8 +2,15 @@
 # © 2014 Numérigraphe SARL
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import logging
+
 from openerp import models, fields, api
 from openerp.addons import decimal_precision as dp
+from openerp.addons.stock_available.models.profiling import profiled
+
+from ..potential_matrix import np, dense_needs, joint_potential
+
+_logger = logging.getLogger(__name__)
 
 
 class ProductTemplate(models.Model):
@@ -17,30 +24,95 @@ class ProductTemplate(models.Model):
         help="Quantity of this Product that could be produced using "
              "the materials already at hand. "
              "If the product has several variants, this will be the biggest "
-             "quantity that can be made for a any single variant.")
+             "quantity that can be made for a any single variant, unless the "
+             "joint potential of the variants is chosen in the settings.")
+
+    @api.multi
+    def write(self, vals):
+        if 'uom_id' in vals:
+            # The component needs are expressed in the products' UoM
+            self.env['product.product'].clear_caches()
+        return super(ProductTemplate, self).write(vals)
 
     @api.multi
     @api.depends('potential_qty')
+    @profiled('stock_available_mrp')
     def _immediately_usable_qty(self):
         """Add the potential quantity to the quantity available to promise.
 
         This is the same implementation as for variants."""
         super(ProductTemplate, self)._immediately_usable_qty()
+        if self.env['product.product']._get_atp_plan():
+            # The formula decides by itself whether the potential is added
+            return
         for tmpl in self:
             tmpl.immediately_usable_qty += tmpl.potential_qty
 
     @api.multi
     @api.depends('product_variant_ids.potential_qty')
+    @profiled('stock_available_mrp')
     def _get_potential_qty(self):
         """Compute the potential as the max of all the variants's potential.
 
         We can't add the potential of variants: if they share components we
         may not be able to make all the variants.
         So we set the arbitrary rule that we can promise up to the biggest
-        variant's potential.
+        variant's potential, unless the joint potential is configured.
         """
+        mode = self.env['stock.config.settings'].get_stock_available_param(
+            'stock_available_mrp_template_potential')
+        if mode == 'joint':
+            if np is not None:
+                return self._get_joint_potential_qty()
+            _logger.warning("NumPy is required to compute the joint "
+                            "potential of the variants.")
         for tmpl in self:
             if not tmpl.product_variant_ids:
                 continue
             tmpl.potential_qty = max(
                 [v.potential_qty for v in tmpl.product_variant_ids])
+
+    @api.multi
+    def _get_joint_potential_qty(self):
+        """Compute the potential as the quantity of all the variants that can
+        be made together, sharing the components at hand.
+
+        The components are allocated to the variants within the time budget
+        set by the parameter `stock_available_mrp_joint_time_budget`, in
+        seconds.
+        """
+        product_obj = self.env['product.product']
+        time_budget = float(
+            self.env['stock.config.settings'].get_stock_available_param(
+                'stock_available_mrp_joint_time_budget'))
+
+        variants = self.mapped('product_variant_ids')
+        product_boms = variants._get_boms()
+        needs = product_obj._get_components_needs_batch(product_boms)
+        component_ids = set()
+        for component_needs in needs.values():
+            component_ids.update(c.id for c in component_needs)
+        component_qties = product_obj._get_components_qty(
+            product_obj.browse(list(component_ids)))
+
+        for tmpl in self:
+            tmpl_variants = [v for v in tmpl.product_variant_ids
+                             if needs.get(v)]
+            if not tmpl_variants:
+                tmpl.potential_qty = 0.0
+                continue
+            variant_needs = {
+                v.id: {c.id: need for c, need in needs[v].items()}
+                for v in tmpl_variants}
+            columns = sorted(set(
+                c_id for v_needs in variant_needs.values()
+                for c_id in v_needs))
+            matrix = dense_needs(
+                *product_obj._get_needs_coo(
+                    [v.id for v in tmpl_variants], variant_needs, columns),
+                shape=(len(tmpl_variants), len(columns)))
+            stock = np.array([component_qties[c] for c in columns])
+            bom_qties = np.array([product_obj._get_bom_qty(product_boms[v])
+                                  for v in tmpl_variants])
+            runs = joint_potential(matrix, stock, bom_qties, time_budget)
+            tmpl.potential_qty = float(runs.dot(bom_qties))
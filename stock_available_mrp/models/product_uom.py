@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# © 2014 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from openerp import models, api
+
+
+class ProductUom(models.Model):
+    _inherit = 'product.uom'
+
+    @api.model
+    def create(self, vals):
+        # The component needs depend on the UoM conversions
+        self.env['product.product'].clear_caches()
+        return super(ProductUom, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.env['product.product'].clear_caches()
+        return super(ProductUom, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['product.product'].clear_caches()
+        return super(ProductUom, self).unlink()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# © 2014 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+"""Matrix computations of the production potential, based on NumPy."""
+
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    _logger.debug('Cannot `import numpy`.')
+    np = None
+
+
+def min_floor_division(rows, columns, needs, stock, size):
+    """Return how many times each BoM can be run with the stock at hand.
+
+    The needs are given as a sparse matrix in coordinate format: the BoM of
+    row ``rows[i]`` needs ``needs[i]`` of the component ``columns[i]``.
+    Each row must have at least one entry.
+
+    :param rows: array of the row of each entry
+    :param columns: array of the column of each entry
+    :param needs: array of the need of each entry
+    :param stock: (components,) array of the available qty of components
+    :param size: number of rows
+    :return: (size,) array of the minimum of ``stock // need`` of each row
+    """
+    ratios = np.floor_divide(stock[columns], needs)
+    runs = np.full(size, np.inf)
+    np.minimum.at(runs, rows, ratios)
+    return runs
+
+
+def dense_needs(rows, columns, needs, shape):
+    """Return the matrix of the needs given in coordinate format.
+
+    :param rows: array of the row of each entry
+    :param columns: array of the column of each entry
+    :param needs: array of the need of each entry
+    :param shape: (rows, columns) shape of the matrix
+    :return: array of the given shape, 0 where nothing is needed
+    """
+    matrix = np.zeros(shape)
+    matrix[rows, columns] = needs
+    return matrix
+
+
+def runs_per_variant(needs, stock):
+    """Return how many times each BoM can be run with the stock at hand.
+
+    :param needs: (variants x components) array of the qty of each component
+                  needed by one run of each BoM, 0 when not needed
+    :param stock: (components,) array of the available qty of components
+    :return: (variants,) array of the number of runs of each BoM alone
+    """
+    used = needs > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        runs = np.where(used, np.floor_divide(stock, needs), np.inf)
+    runs = runs.min(axis=1)
+    runs[~used.any(axis=1)] = 0.0
+    return np.maximum(runs, 0.0)
+
+
+def joint_potential(needs, stock, bom_qties, time_budget=0.5):
+    """Share the stock of components between several BoMs.
+
+    The allocation is greedy: at each step, the BoM which consumes the
+    scarcest components the least per unit produced gets half of the runs
+    it could make with the remaining stock, until no BoM can be run any
+    more or the time budget is spent.
+
+    The exact allocation is an integer linear program, NP-hard in general,
+    and would need a solver which is not a dependency of this module. The
+    greedy result is never worse than running the single most productive
+    BoM. As no BoM can be run more often in the optimal allocation than on
+    its own, the result is at least the optimum divided by the number of
+    BoMs; it may be below the optimum when a BoM efficient per unit leaves
+    unusable leftovers (see the tests).
+
+    :param needs: (variants x components) array of the qty of each component
+                  needed by one run of each BoM, 0 when not needed
+    :param stock: (components,) array of the available qty of components
+    :param bom_qties: (variants,) array of the qty made by one run of each BoM
+    :param time_budget: seconds after which the best allocation found so far
+                        is returned
+    :return: (variants,) array of the number of runs of each BoM
+    """
+    needs = np.asarray(needs, dtype=float)
+    remaining = np.maximum(np.asarray(stock, dtype=float), 0.0)
+    bom_qties = np.asarray(bom_qties, dtype=float)
+
+    # Baseline: run the single most productive BoM
+    single_runs = runs_per_variant(needs, remaining)
+    best = np.zeros(len(bom_qties))
+    if len(best):
+        variant = np.argmax(single_runs * bom_qties)
+        best[variant] = single_runs[variant]
+
+    deadline = time.time() + time_budget
+    runs = np.zeros(len(bom_qties))
+    while time.time() < deadline:
+        feasible = runs_per_variant(needs, remaining)
+        candidates = feasible >= 1
+        if not candidates.any():
+            break
+        # Scarce components are expensive
+        prices = 1.0 / np.maximum(remaining, 1e-9)
+        costs = needs.dot(prices) / np.maximum(bom_qties, 1e-9)
+        costs[~candidates] = np.inf
+        variant = np.argmin(costs)
+        step = max(1.0, np.floor(feasible[variant] / 2.0))
+        runs[variant] += step
+        remaining -= step * needs[variant]
+    else:
+        _logger.debug('Time budget spent while sharing the components of '
+                      '%d BoMs', len(bom_qties))
+
+    if runs.dot(bom_qties) >= best.dot(bom_qties):
+        return runs
+    return best
@@ -2,9 +2,15 @@
 # © 2014 Numérigraphe SARL
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import json
+import unittest
+
 from openerp.tests.common import TransactionCase
 from openerp.osv.expression import TRUE_LEAF
 
+from ..benchmark import run_benchmark
+from ..potential_matrix import np, joint_potential
+
 
 class TestPotentialQty(TransactionCase):
     """Test the potential quantity on a product with a multi-line BoM"""
@@ -538,3 +544,135 @@ class TestPotentialQty(TransactionCase):
             {p1.id: 3.0, p2.id: 3.0, p3.id: 0.0},
             {p.id: p.potential_qty for p in products}
         )
+
+    def test_potential_qty_batch(self):
+        # The batch engine must find the same BoMs as _bom_find and give
+        # the same potential as when computing the products one by one
+        products = self.product_model.search(
+            [('bom_ids', '!=', False)]) | self.tmpl.product_variant_ids
+        boms = products._get_boms()
+        for product in products:
+            bom_id = self.bom_model._bom_find(product_id=product.id)
+            self.assertEqual(bom_id or False,
+                             boms.get(product, self.bom_model).id,
+                             "Wrong BoM for %s" % product.name)
+
+        self.create_inventory(self.ref('product.product_product_23'), 1000)
+        self.create_inventory(self.ref('product.product_product_15'), 1000)
+        self.product_model.invalidate_cache()
+        batch = {p.id: p.potential_qty for p in products}
+        for product in products:
+            self.product_model.invalidate_cache()
+            self.assertEqual(batch[product.id],
+                             self.product_model.browse(product.id)
+                             .potential_qty)
+
+    def test_components_needs_cache(self):
+        p1 = self.product_model.create({'name': 'Test P1'})
+        p2 = self.product_model.create({'name': 'Test P2'})
+        bom = self.create_simple_bom(p1, p2, sub_product_qty=2)
+        self.create_inventory(p2.id, 10)
+
+        p1.refresh()
+        self.assertEqual(5.0, p1.potential_qty)
+        stats = self.product_model.get_components_needs_cache_stats()
+
+        # The needs are not exploded again
+        self.product_model.invalidate_cache()
+        self.assertEqual(5.0, p1.potential_qty)
+        new_stats = self.product_model.get_components_needs_cache_stats()
+        self.assertEqual(stats['miss'], new_stats['miss'])
+        self.assertGreater(new_stats['hit'], stats['hit'])
+
+        # Changing the BoM invalidates the cache
+        bom.bom_line_ids.write({'product_qty': 5})
+        self.product_model.invalidate_cache()
+        self.assertEqual(2.0, p1.potential_qty)
+        new_stats = self.product_model.get_components_needs_cache_stats()
+        self.assertGreater(new_stats['miss'], stats['miss'])
+
+    def test_potential_qty_cycle(self):
+        # A cycle in the BoMs is reported instead of recursing forever
+        p1 = self.product_model.create({'name': 'Test P1'})
+        p2 = self.product_model.create({'name': 'Test P2'})
+        self.create_simple_bom(p1, p2)
+        self.create_simple_bom(p2, p1)
+        self.create_inventory(p2.id, 4)
+
+        self.config.set_param('stock_available_mrp_based_on',
+                              'immediately_usable_qty')
+        self.product_model.invalidate_cache()
+        self.assertEqual(4.0, p1.potential_qty)
+
+    def test_atp_matrix_default_plan(self):
+        # The potential stays in the plan whatever the modules loaded after
+        # this one, e.g. stock_available_immediately
+        plan = self.product_model._get_atp_matrix_default_plan()
+        self.assertIn((1.0, 'potential'), plan)
+        immediately = self.env['ir.module.module'].search(
+            [('name', '=', 'stock_available_immediately'),
+             ('state', '=', 'installed')])
+        if immediately:
+            self.assertIn((-1.0, 'incoming'), plan)
+
+    def test_atp_dependent_products(self):
+        # The stored ATP of the products made of a component, at all
+        # levels, is refreshed with the component's
+        p1 = self.product_model.create({'name': 'Test P1'})
+        p2 = self.product_model.create({'name': 'Test P2'})
+        p3 = self.product_model.create({'name': 'Test P3'})
+        self.create_simple_bom(p1, p2)
+        self.create_simple_bom(p2, p3)
+        self.assertEqual(p1 | p2 | p3, p3._get_atp_dependent_products())
+        self.assertEqual(p1, p1._get_atp_dependent_products())
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_joint_potential(self):
+        # 2 BoMs sharing the 10 units of the first component
+        needs = np.array([[1.0, 1.0, 0.0],
+                          [1.0, 0.0, 1.0]])
+        stock = np.array([10.0, 4.0, 7.0])
+        runs = joint_potential(needs, stock, np.array([1.0, 1.0]))
+        self.assertEqual(10.0, runs.sum())
+        self.assertTrue((needs.T.dot(runs) <= stock).all())
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_joint_potential_suboptimal(self):
+        # The first BoM is the most efficient per unit, but leaves 1 unit
+        # of the first component unused: running the second BoM twice and
+        # the third once would make 7
+        needs = np.array([[3.0, 0.0],
+                          [2.0, 0.0],
+                          [0.0, 1.0]])
+        stock = np.array([4.0, 1.0])
+        bom_qties = np.array([5.0, 3.0, 1.0])
+        runs = joint_potential(needs, stock, bom_qties)
+        self.assertEqual(6.0, runs.dot(bom_qties))
+        # Never below the optimum divided by the number of BoMs
+        self.assertGreaterEqual(runs.dot(bom_qties), 7.0 / len(bom_qties))
+        self.assertTrue((needs.T.dot(runs) <= stock).all())
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_potential_qty_vectorized(self):
+        # NumPy must give the same potential as plain python
+        products = self.product_model.search(
+            [('bom_ids', '!=', False)]) | self.tmpl.product_variant_ids
+        self.create_inventory(self.ref('product.product_product_23'), 1000)
+        self.create_inventory(self.ref('product.product_product_15'), 7)
+        scalar = products.with_context(
+            vectorize_potential_qty=False)._compute_potential_qties()
+        vectorized = products.with_context(
+            vectorize_potential_qty=True)._compute_potential_qties()
+        self.assertEqual(scalar, vectorized)
+
+    def test_benchmark(self):
+        # Smoke test of the benchmark harness on a tiny catalogue
+        report = json.loads(run_benchmark(self.env, sizes=(1, 4), variants=2,
+                                          depth=2, width=2, locations=2))
+        self.assertEqual(4, len(report['results']))
+        for result in report['results']:
+            self.assertTrue(set(result) >= {'queries', 'seconds',
+                                            'new_process_peak_kb'})
+        potentials = [r for r in report['results']
+                      if r['field'] == 'potential_qty']
+        self.assertEqual([1, 4], [r['size'] for r in potentials])
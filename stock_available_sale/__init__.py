@@ -19,3 +19,5 @@
 ##############################################################################
 
 from . import product
+from . import sale
+from . import sale_quoted_qty
@@ -29,7 +29,9 @@
         'sale_stock',
     ],
     'data': [
+        'security/ir.model.access.csv',
         'product_view.xml',
+        'sale_quoted_qty_data.xml',
     ],
     'test': [
         'test/quoted_qty.yml',
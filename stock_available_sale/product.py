@@ -18,12 +18,23 @@
 #
 ##############################################################################
 
-from openerp import SUPERUSER_ID
+from openerp import SUPERUSER_ID, api, tools
 from openerp.osv import orm, fields
+from openerp.tools import float_round
 import openerp.addons.decimal_precision as dp
 
 # Function which uses the pool to call the method from the other modules too.
 from openerp.addons.stock_available import _product_available_fnct
+from openerp.addons.stock_available.models.profiling import profile
+
+from .sale_quoted_qty import QUOTED_PRODUCT_QUERY
+
+
+def _round(qty, rounding):
+    """Round a quantity like a UoM, which may have no rounding"""
+    if not rounding:
+        return qty
+    return float_round(qty, precision_rounding=rounding)
 
 
 class ProductProduct(orm.Model):
@@ -33,155 +44,143 @@ class ProductProduct(orm.Model):
     def _product_available(self, cr, uid, ids, field_names=None, arg=False,
                            context=None):
         """Compute the quantities in Quotations."""
+        env = api.Environment(cr, uid, context or {})
+        with profile(env, 'stock_available_sale',
+                     'product.product._product_available', len(ids)):
+            return self._product_available_quoted(
+                cr, uid, ids, field_names=field_names, arg=arg,
+                context=context)
+
+    def _product_available_quoted(self, cr, uid, ids, field_names=None,
+                                  arg=False, context=None):
+        """Subtract the quantities in Quotations from the core quantities.
+
+        The quotations of all the products are summed up in the UoM of each
+        product in a single query. They are subtracted from the core
+        quantities, also in the UoM of the product, then the totals are
+        converted to the UoM of the context if any.
+        """
         # Compute the core quantities
         res = super(ProductProduct, self)._product_available(
             cr, uid, ids, field_names=field_names, arg=arg, context=context)
         # If we didn't get a field_names list, there's nothing to do
-        if field_names is None:
+        if field_names is None or not ids:
+            return res
+        if not any([f in field_names
+                    for f in ['quoted_qty', 'immediately_usable_qty']]):
             return res
 
         if context is None:
             context = {}
-        # Prepare an alternative context without 'uom', to avoid cross-category
-        # conversions when reading the available stock of components
-        if 'uom' in context:
-            context_wo_uom = context.copy()
-            del context_wo_uom['uom']
-        else:
-            context_wo_uom = context
-        # Compute the quantities quoted/available to promise
-        if any([f in field_names
-                for f in ['quoted_qty', 'immediately_usable_qty']]):
-            date_str, date_args = self._get_dates(cr, uid, ids,
-                                                  context=context)
-
-            # Limit the search to some shops according to the context
-            shop_str, shop_args = self._get_shops(cr, uid, ids,
-                                                  context=context)
-
-            # Query the total by Product and UoM
-            cr.execute(
-                """
-                SELECT sum(product_uom_qty), product_id, product_uom
-                FROM sale_order_line
-                INNER JOIN sale_order
-                     ON (sale_order_line.order_id = sale_order.id)
-                WHERE product_id in %s
-                      AND sale_order_line.state = 'draft' """ +
-                date_str + shop_str +
-                "GROUP BY sale_order_line.product_id, product_uom",
-                (tuple(ids),) + date_args + shop_args)
-            results = cr.fetchall()
-
-            # Get the UoM resources we'll need for conversion
-            # UoMs from the products
-            uoms_o = {}
-            product2uom = {}
-            for product in self.browse(cr, uid, ids, context=context):
-                product2uom[product.id] = product.uom_id
-                uoms_o[product.uom_id.id] = product.uom_id
-            # UoM from the results and the context
-            uom_obj = self.pool['product.uom']
-            uoms = map(lambda stock_product_uom_qty: stock_product_uom_qty[2],
-                       results)
-            if context.get('uom', False):
-                uoms.append(context['uom'])
-            uoms = filter(lambda stock_product_uom_qty:
-                          stock_product_uom_qty not in uoms_o.keys(), uoms)
-            if uoms:
-                uoms = uom_obj.browse(cr, SUPERUSER_ID, list(set(uoms)),
-                                      context=context)
-            for o in uoms:
-                uoms_o[o.id] = o
-
-            # Compute the quoted quantity
-            for (amount, prod_id, prod_uom) in results:
-                # Convert the amount to the product's UoM without rounding
-                amount = amount / uoms_o[prod_uom].factor
-                if 'quoted_qty' in field_names:
-                    res[prod_id]['quoted_qty'] -= amount
-                if 'immediately_usable_qty' in field_names:
-                    res[prod_id]['immediately_usable_qty'] -= amount
-
-            # Round and optionally convert the results to the requested UoM
-            for prod_id, stock_qty in res.iteritems():
-                if context.get('uom', False):
-                    # Convert to the requested UoM
-                    res_uom = uoms_o[context['uom']]
-                else:
-                    # The conversion is unneeded but we do need the rounding
-                    res_uom = product2uom[prod_id]
-                if 'quoted_qty' in field_names:
-                    stock_qty['quoted_qty'] = uom_obj._compute_qty_obj(
-                        cr, SUPERUSER_ID, product2uom[prod_id],
-                        stock_qty['quoted_qty'],
-                        res_uom)
-                if 'immediately_usable_qty' in field_names:
-                    stock_qty['immediately_usable_qty'] = \
-                        uom_obj._compute_qty_obj(
-                            cr, SUPERUSER_ID, product2uom[prod_id],
-                            stock_qty['immediately_usable_qty'],
-                            res_uom)
+        date_str, date_args = self._get_dates(cr, uid, ids, context=context)
+        # Limit the search to some shops according to the context
+        shop_str, shop_args = self._get_shops(cr, uid, ids, context=context)
+
+        # Query the total by Product from the summary of the quotations, in
+        # the reference UoM, then convert it to the UoM of the product. Also
+        # get the ratio to convert the totals to the UoM of the context.
+        cr.execute(
+            """
+            SELECT product_product.id,
+                   COALESCE(quoted.qty, 0.0) * product_uom.factor,
+                   COALESCE(context_uom.factor / product_uom.factor, 1.0),
+                   COALESCE(context_uom.rounding, product_uom.rounding)
+            FROM product_product
+            INNER JOIN product_template
+                 ON (product_template.id = product_product.product_tmpl_id)
+            INNER JOIN product_uom
+                 ON (product_uom.id = product_template.uom_id)
+            LEFT JOIN product_uom context_uom ON (context_uom.id = %s)
+            LEFT JOIN (""" + QUOTED_PRODUCT_QUERY % (date_str + shop_str) +
+            """) AS quoted ON (quoted.product_id = product_product.id)
+            WHERE product_product.id IN %s""",
+            (context.get('uom') or None, tuple(ids)) + date_args +
+            shop_args + (tuple(ids),))
+        # A formula of the quantity available to promise decides by
+        # itself whether the quotations are subtracted
+        atp_plan = self._get_atp_plan(cr, uid, context=context)
+
+        # Compute the quoted quantity, then convert and round the results
+        for prod_id, amount, ratio, rounding in cr.fetchall():
+            stock_qty = res[prod_id]
+            if 'quoted_qty' in field_names:
+                stock_qty['quoted_qty'] = _round(
+                    (stock_qty['quoted_qty'] - amount) * ratio, rounding)
+            if 'immediately_usable_qty' in field_names:
+                qty = stock_qty['immediately_usable_qty']
+                if not atp_plan:
+                    qty -= amount
+                stock_qty['immediately_usable_qty'] = _round(
+                    qty * ratio, rounding)
         return res
 
     def _get_shops(self, cr, uid, ids, context=None):
         """Find the shops matching the current context
 
         See the helptext for the field quoted_qty for details"""
-        shop_ids = []
+        if context is None:
+            context = {}
         # Account for one or several locations in the context
-        # Take any shop using any warehouse that has these locations as stock
-        # location
-        if context.get('location', False):
-            # Either a single or multiple locations can be in the context
-            if isinstance(context['location'], (int, long)):
-                location_ids = [context['location']]
-            else:
-                location_ids = context['location']
+        # Either a single or multiple locations can be in the context
+        location_ids = context.get('location') or ()
+        if isinstance(location_ids, (int, long)):
+            location_ids = (location_ids,)
+        shop_ids = list(self._get_context_shop_ids(
+            cr, uid, tuple(location_ids),
+            bool(context.get('compute_child', True)),
+            int(context.get('warehouse') or 0)))
+
+        # If we are in a single Shop context, only count the quotations from
+        # this shop
+        if context.get('shop', False):
+            shop_ids.append(context['shop'])
+        # Build the SQL to restrict to the selected shops
+        if not shop_ids:
+            return '', ()
+        return 'AND sale_quoted_qty.shop_id IN %s ', (tuple(shop_ids),)
+
+    @tools.ormcache('location_ids', 'compute_child', 'warehouse_id')
+    def _get_context_shop_ids(self, cr, uid, location_ids, compute_child,
+                              warehouse_id):
+        """Find the shops using the warehouses of some locations or a
+        warehouse, once for each context.
+
+        The cache is cleared when the shops, warehouses or the tree of
+        locations change.
+
+        :param location_ids: tuple of location ids
+        :param compute_child: whether the children of the locations count
+        :param warehouse_id: id of a warehouse, or 0
+        :return: tuple of shop ids
+        """
+        shop_ids = []
+        if location_ids:
             # Add the children locations
-            if context.get('compute_child', True):
+            if compute_child:
                 child_location_ids = self.pool['stock.location'].search(
                     cr, SUPERUSER_ID,
-                    [('location_id', 'child_of', location_ids)])
-                location_ids = child_location_ids or location_ids
-            # Get the corresponding Shops
+                    [('location_id', 'child_of', list(location_ids))])
+                location_ids = tuple(child_location_ids) or location_ids
+            # Take any shop using any warehouse that has these locations as
+            # stock location
             cr.execute(
                 """
-                SELECT id FROM sale_shop
-                WHERE warehouse_id IN (
-                    SELECT id
-                    FROM stock_warehouse
-                    WHERE lot_stock_id IN %s)""",
-                (tuple(location_ids),))
-            res_location = cr.fetchone()
-            if res_location:
-                shop_ids.append(res_location)
+                SELECT sale_shop.id FROM sale_shop
+                INNER JOIN stock_warehouse
+                     ON (sale_shop.warehouse_id = stock_warehouse.id)
+                WHERE stock_warehouse.lot_stock_id IN %s""",
+                (location_ids,))
+            shop_ids.extend(row[0] for row in cr.fetchall())
 
         # Account for a warehouse in the context
         # Take any draft order in any shop using this warehouse
-        if context.get('warehouse', False):
+        if warehouse_id:
             cr.execute("SELECT id "
                        "FROM sale_shop "
                        "WHERE warehouse_id = %s",
-                       (int(context['warehouse']),))
-            res_wh = cr.fetchone()
-            if res_wh:
-                shop_ids.append(res_wh)
-
-        # If we are in a single Shop context, only count the quotations from
-        # this shop
-        if context.get('shop', False):
-            shop_ids.append(context['shop'])
-        # Build the SQL to restrict to the selected shops
-        shop_str = ''
-        if shop_ids:
-            shop_str = 'AND sale_order.shop_id IN %s'
-
-        if shop_ids:
-            shop_ids = (tuple(shop_ids),)
-        else:
-            shop_ids = ()
-        return shop_str, shop_ids
+                       (warehouse_id,))
+            shop_ids.extend(row[0] for row in cr.fetchall())
+        return tuple(shop_ids)
 
     def _get_dates(self, cr, uid, ids, context=None):
         """Build SQL criteria to match the context's from/to dates"""
@@ -195,22 +194,15 @@ class ProductProduct(orm.Model):
         to_date = context.get('to_date', False)
         date_str = ''
         date_args = []
+        # The summary of the quotations holds this date
         if from_date:
-            date_str = """AND COALESCE(
-                              sale_order.requested_date,
-                              sale_order.date_order) >= %s """
+            date_str = "AND sale_quoted_qty.date >= %s "
             date_args.append(from_date)
         if to_date:
-            date_str += """AND COALESCE(
-                               sale_order.requested_date,
-                               sale_order.date_order) <= %s """
+            date_str += "AND sale_quoted_qty.date <= %s "
             date_args.append(to_date)
 
-        if date_args:
-            date_args = (tuple(date_args),)
-        else:
-            date_args = ()
-        return date_str, date_args
+        return date_str, tuple(date_args)
 
     _columns = {
         'quoted_qty': fields.function(
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This module is copyright (C) 2014 Numérigraphe SARL. All Rights Reserved.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp import models, api
+
+from .sale_quoted_qty import QUOTED_WAREHOUSE_QUERY
+
+# Fields of the sale order lines changing the quoted quantity
+QUOTED_LINE_FIELDS = ('product_id', 'product_uom_qty', 'product_uom',
+                      'state', 'order_id')
+
+# Fields of the sale orders changing the quoted quantity
+QUOTED_ORDER_FIELDS = ('state', 'shop_id', 'requested_date', 'date_order')
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    @api.model
+    def _get_atp_terms(self):
+        """Add the quotations to the terms of the ATP formulas"""
+        terms = super(ProductProduct, self)._get_atp_terms()
+        terms['quoted'] = '_get_atp_quoted_qty'
+        return terms
+
+    @api.multi
+    def _get_atp_quoted_qty(self):
+        """Return the quantity in quotations, as a positive quantity"""
+        return {product.id: -product.quoted_qty for product in self}
+
+    @api.model
+    def _get_atp_matrix_default_plan(self):
+        """Subtract the quotations in the matrix too"""
+        return super(ProductProduct, self)._get_atp_matrix_default_plan() + (
+            (-1.0, 'quoted'),)
+
+    @api.multi
+    def _get_atp_matrix_values(self, terms, warehouses):
+        """Compute the quotations of all the warehouses in one query on
+        their summary, grouped by the warehouse of their shop"""
+        if 'quoted' not in terms:
+            return super(ProductProduct, self)._get_atp_matrix_values(
+                terms, warehouses)
+        values = super(ProductProduct, self)._get_atp_matrix_values(
+            set(terms) - {'quoted'}, warehouses)
+        quoted = values['quoted'] = {}
+        if not self.ids or not warehouses:
+            return values
+        self.env.cr.execute(QUOTED_WAREHOUSE_QUERY,
+                            (tuple(self.ids), tuple(warehouses.ids)))
+        for product_id, warehouse_id, qty in self.env.cr.fetchall():
+            quoted[(product_id, warehouse_id)] = qty
+        return values
+
+
+class SaleOrderLine(models.Model):
+    """Keep the quoted quantities and the stored quantity available to
+    promise up to date"""
+    _inherit = 'sale.order.line'
+
+    @api.model
+    def create(self, vals):
+        line = super(SaleOrderLine, self).create(vals)
+        self.env['sale.quoted.qty'].add_lines(line.ids)
+        line.product_id._notify_atp_change()
+        return line
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in QUOTED_LINE_FIELDS):
+            return super(SaleOrderLine, self).write(vals)
+        quoted_obj = self.env['sale.quoted.qty']
+        products = self.mapped('product_id')
+        quoted_obj.add_lines(self.ids, -1)
+        res = super(SaleOrderLine, self).write(vals)
+        quoted_obj.add_lines(self.ids)
+        (products | self.mapped('product_id'))._notify_atp_change()
+        return res
+
+    @api.multi
+    def unlink(self):
+        products = self.mapped('product_id')
+        self.env['sale.quoted.qty'].add_lines(self.ids, -1)
+        res = super(SaleOrderLine, self).unlink()
+        products._notify_atp_change()
+        return res
+
+
+class SaleOrder(models.Model):
+    """Keep the quoted quantities and the stored quantity available to
+    promise up to date"""
+    _inherit = 'sale.order'
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in QUOTED_ORDER_FIELDS):
+            return super(SaleOrder, self).write(vals)
+        quoted_obj = self.env['sale.quoted.qty']
+        lines = self.mapped('order_line')
+        quoted_obj.add_lines(lines.ids, -1)
+        res = super(SaleOrder, self).write(vals)
+        quoted_obj.add_lines(lines.ids)
+        lines.mapped('product_id')._notify_atp_change()
+        return res
+
+    @api.multi
+    def unlink(self):
+        # The lines are deleted in cascade, without calling their unlink()
+        lines = self.mapped('order_line')
+        products = lines.mapped('product_id')
+        self.env['sale.quoted.qty'].add_lines(lines.ids, -1)
+        res = super(SaleOrder, self).unlink()
+        products._notify_atp_change()
+        return res
+
+
+class SaleShop(models.Model):
+    """Clear the cached shops of the stock contexts when they change"""
+    _inherit = 'sale.shop'
+
+    @api.model
+    def create(self, vals):
+        self.env['product.product'].clear_caches()
+        return super(SaleShop, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if 'warehouse_id' in vals:
+            self.env['product.product'].clear_caches()
+        return super(SaleShop, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['product.product'].clear_caches()
+        return super(SaleShop, self).unlink()
+
+
+class StockWarehouse(models.Model):
+    """Clear the cached shops of the stock contexts when they change"""
+    _inherit = 'stock.warehouse'
+
+    @api.model
+    def create(self, vals):
+        self.env['product.product'].clear_caches()
+        return super(StockWarehouse, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        if 'lot_stock_id' in vals:
+            self.env['product.product'].clear_caches()
+        return super(StockWarehouse, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['product.product'].clear_caches()
+        return super(StockWarehouse, self).unlink()
+
+
+class StockLocation(models.Model):
+    """Clear the cached shops of the stock contexts when the tree of
+    locations changes"""
+    _inherit = 'stock.location'
+
+    @api.multi
+    def write(self, vals):
+        if 'location_id' in vals:
+            self.env['product.product'].clear_caches()
+        return super(StockLocation, self).write(vals)
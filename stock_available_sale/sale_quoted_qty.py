@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    This module is copyright (C) 2014 Numérigraphe SARL. All Rights Reserved.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import logging
+
+from openerp import SUPERUSER_ID, models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+# Key of the advisory lock serializing the compactions of the summary
+QUOTED_LOCK_KEY = 0x71756f74
+
+# Sum up the draft lines by product, shop and day, in the reference UoM,
+# multiplied by a sign
+QUOTED_SUMMARY_QUERY = """
+    INSERT INTO sale_quoted_qty (product_id, shop_id, date, qty)
+    SELECT sale_order_line.product_id, sale_order.shop_id,
+           COALESCE(sale_order.requested_date, sale_order.date_order)::date,
+           %%s * SUM(sale_order_line.product_uom_qty / line_uom.factor)
+    FROM sale_order_line
+    INNER JOIN sale_order
+         ON (sale_order_line.order_id = sale_order.id)
+    INNER JOIN product_uom line_uom
+         ON (sale_order_line.product_uom = line_uom.id)
+    WHERE sale_order_line.state = 'draft'
+          AND sale_order_line.product_id IS NOT NULL %s
+    GROUP BY 1, 2, 3
+    """
+
+# Sum up the quotations of some products, with optional criteria on the
+# date and shop of the summary
+QUOTED_PRODUCT_QUERY = """
+    SELECT product_id, SUM(qty) AS qty
+    FROM sale_quoted_qty
+    WHERE product_id IN %%s %s
+    GROUP BY product_id
+    """
+
+# Sum up the quotations of some products per warehouse of their shop
+QUOTED_WAREHOUSE_QUERY = """
+    SELECT sale_quoted_qty.product_id, sale_shop.warehouse_id,
+           SUM(sale_quoted_qty.qty)
+    FROM sale_quoted_qty
+    INNER JOIN sale_shop ON (sale_quoted_qty.shop_id = sale_shop.id)
+    WHERE sale_quoted_qty.product_id IN %s
+          AND sale_shop.warehouse_id IN %s
+    GROUP BY 1, 2
+    """
+
+# Indexes of the queries on the summary: name, table, expression
+QUOTED_INDEXES = [
+    ('sale_quoted_qty_product_date_index', 'sale_quoted_qty',
+     '(product_id, date)'),
+]
+
+# Indexes created by the previous versions, which no query uses any more
+QUOTED_OBSOLETE_INDEXES = [
+    'sale_order_line_draft_product_index',
+    'sale_order_draft_quoted_date_index',
+]
+
+# Queries run by the module, with sample parameters, and the index their
+# plan should use
+QUOTED_INDEX_CHECKS = {
+    'quoted_qty': (
+        'sale_quoted_qty_product_date_index',
+        QUOTED_PRODUCT_QUERY % '', ((0,),)),
+    'quoted_qty_dates': (
+        'sale_quoted_qty_product_date_index',
+        QUOTED_PRODUCT_QUERY % ("AND sale_quoted_qty.date >= %s "
+                                "AND sale_quoted_qty.date <= %s "),
+        ((0,), '2000-01-01', '2000-01-31')),
+    'atp_matrix': (
+        'sale_quoted_qty_product_date_index',
+        QUOTED_WAREHOUSE_QUERY, ((0,), (0,))),
+}
+
+
+class SaleQuotedQty(models.Model):
+    """Summary of the quantities in Quotations (Draft Sale Orders), per
+    product, shop and requested date, in the reference UoM of the products.
+
+    The quantities of the lines are added when they are created or start
+    counting, and subtracted when they are deleted or stop counting: the
+    table is only appended to, and the quantity of a product, shop and date
+    is the sum of its rows. Concurrent transactions changing the
+    quotations of the same product never update the same rows, so they
+    don't conflict on the summary. The rows are merged back by `compact`.
+    """
+    _name = 'sale.quoted.qty'
+    _description = 'Quantities in quotations'
+    _log_access = False
+
+    product_id = fields.Many2one('product.product', string='Product',
+                                 readonly=True)
+    shop_id = fields.Many2one('sale.shop', string='Shop', readonly=True)
+    date = fields.Date(
+        readonly=True,
+        help="Requested date of the quotation, or date of the quotation if "
+             "none was requested")
+    qty = fields.Float(string='Quantity', readonly=True)
+
+    def init(self, cr):
+        for name in QUOTED_OBSOLETE_INDEXES:
+            cr.execute("DROP INDEX IF EXISTS %s" % name)
+        for name, table, expression in QUOTED_INDEXES:
+            cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                       (name,))
+            if not cr.fetchone():
+                _logger.info('Creating the index %s', name)
+                cr.execute("CREATE INDEX %s ON %s %s" % (
+                    name, table, expression))
+        # Fill the summary when the module is installed or updated
+        self.rebuild(cr, SUPERUSER_ID)
+
+    @api.model
+    def check_indexes(self):
+        """Check that the planner uses the index on the summary for the
+        queries reading it.
+
+        Sequential scans are disabled during the check, so that the result
+        doesn't depend on the size of the tables.
+
+        :return: dict mapping the names of the queries to whether their
+                 plan uses their index
+        """
+        cr = self.env.cr
+        used = {}
+        cr.execute("SAVEPOINT check_quoted_indexes")
+        try:
+            cr.execute("SET LOCAL enable_seqscan = off")
+            for check, (name, query, params) in QUOTED_INDEX_CHECKS.items():
+                cr.execute("EXPLAIN " + query, params)
+                plan = "\n".join(row[0] for row in cr.fetchall())
+                _logger.debug('Plan of the query %s:\n%s', check, plan)
+                used[check] = name in plan
+        finally:
+            # Restore enable_seqscan
+            cr.execute("ROLLBACK TO SAVEPOINT check_quoted_indexes")
+        return used
+
+    @api.model
+    def rebuild(self):
+        """Rebuild the whole summary from the sale order lines"""
+        _logger.info('Rebuilding the summary of the quoted quantities')
+        self.env.cr.execute("LOCK TABLE sale_quoted_qty IN EXCLUSIVE MODE")
+        self.env.cr.execute("DELETE FROM sale_quoted_qty")
+        self.env.cr.execute(QUOTED_SUMMARY_QUERY % '', (1,))
+        self.invalidate_cache()
+        return True
+
+    @api.model
+    def add_lines(self, line_ids, sign=1):
+        """Add the quantities of some sale order lines to the summary, as
+        they are in the current transaction.
+
+        :param line_ids: ids of the lines; the lines which are not draft
+                         don't count
+        :param sign: -1 to subtract the quantities instead
+        """
+        if not line_ids:
+            return
+        self.env.cr.execute(
+            QUOTED_SUMMARY_QUERY % "AND sale_order_line.id IN %s",
+            (sign, tuple(line_ids)))
+        self.invalidate_cache()
+
+    @api.model
+    def compact(self):
+        """Merge the rows of each product, shop and date, and delete the
+        ones adding up to 0.
+
+        Only the rows committed before this transaction started are merged,
+        the ones added meanwhile are left untouched. Nothing is done if
+        another compaction is running.
+        """
+        cr = self.env.cr
+        cr.execute("SELECT pg_try_advisory_xact_lock(%s, 0)",
+                   (QUOTED_LOCK_KEY,))
+        if not cr.fetchone()[0]:
+            return False
+        cr.execute("""
+            WITH merged AS (
+                DELETE FROM sale_quoted_qty
+                RETURNING product_id, shop_id, date, qty
+            )
+            INSERT INTO sale_quoted_qty (product_id, shop_id, date, qty)
+            SELECT product_id, shop_id, date, SUM(qty)
+            FROM merged
+            GROUP BY product_id, shop_id, date
+            HAVING ABS(SUM(qty)) >= 0.000001
+            """)
+        self.invalidate_cache()
+        return True
@@ -33,6 +33,7 @@
  'demo': [],
  'data': ['view/stock_reserve.xml',
           'view/product.xml',
+          'view/stock_reservation_summary.xml',
           'data/stock_data.xml',
           'security/ir.model.access.csv',
           ],
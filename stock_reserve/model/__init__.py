@@ -21,3 +21,6 @@
 
 from . import stock_reserve
 from . import product
+from . import stock_picking
+from . import stock_move
+from . import stock_reservation_summary
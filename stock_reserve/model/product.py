@@ -29,10 +29,13 @@ class ProductTemplate(models.Model):
         compute='_reservation_count',
         string='# Sales')
 
-    @api.one
+    @api.multi
     def _reservation_count(self):
-        self.reservation_count = sum(variant.reservation_count
-                                     for variant in self.product_variant_ids)
+        variants = self.mapped('product_variant_ids')
+        counts = variants._get_reservation_counts()
+        for template in self:
+            template.reservation_count = sum(
+                counts[variant.id] for variant in template.product_variant_ids)
 
     @api.multi
     def action_view_reservations(self):
@@ -55,13 +58,29 @@ class ProductProduct(models.Model):
         compute='_reservation_count',
         string='# Sales')
 
-    @api.one
+    @api.multi
     def _reservation_count(self):
-        domain = [('product_id', '=', self.id),
+        counts = self._get_reservation_counts()
+        for product in self:
+            product.reservation_count = counts[product.id]
+
+    @api.multi
+    def _get_reservation_counts(self):
+        """ Sum up the quantities reserved for all the products at once,
+        from the summary of the reservations
+
+        :return: dict mapping the product ids to the reserved quantities
+        """
+        counts = dict.fromkeys(self.ids, 0.0)
+        if not self.ids:
+            return counts
+        domain = [('product_id', 'in', self.ids),
                   ('state', 'in', ['draft', 'assigned'])]
-        reservations = self.env['stock.reservation'].search(domain)
-        self.reservation_count = sum(reserv.product_qty
-                                     for reserv in reservations)
+        groups = self.env['stock.reservation.summary'].read_group(
+            domain, ['product_id', 'product_qty'], ['product_id'])
+        for group in groups:
+            counts[group['product_id'][0]] = group['product_qty']
+        return counts
 
     @api.multi
     def action_view_reservations(self):
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+from openerp import models, fields, api
+
+# Fields of the moves summed up in the summary of the reservations
+SUMMARY_MOVE_FIELDS = ('state', 'product_id', 'product_uom_qty',
+                       'product_uom', 'location_id', 'restrict_partner_id')
+
+
+class StockMove(models.Model):
+    """ Keep the summary of the reservations up to date """
+    _inherit = 'stock.move'
+
+    is_stock_reservation = fields.Boolean(
+        'Stock Reservation',
+        readonly=True,
+        copy=False,
+        help="Move of a stock reservation")
+
+    def init(self, cr):
+        # Flag the moves of the reservations made before the flag existed
+        cr.execute("UPDATE stock_move SET is_stock_reservation = TRUE "
+                   "WHERE id IN (SELECT move_id FROM stock_reservation) "
+                   "AND is_stock_reservation IS NOT TRUE")
+
+    @api.multi
+    def write(self, vals):
+        if not any(field in vals for field in SUMMARY_MOVE_FIELDS):
+            return super(StockMove, self).write(vals)
+        # The flag is read from the cache for the moves already read, the
+        # other moves don't cost a query to the summary
+        move_ids = self.filtered('is_stock_reservation').ids
+        summary_obj = self.env['stock.reservation.summary'].sudo()
+        summary_obj.add_moves(move_ids, sign=-1)
+        res = super(StockMove, self).write(vals)
+        summary_obj.add_moves(move_ids)
+        return res
+
+    @api.multi
+    def unlink(self):
+        self.env['stock.reservation.summary'].sudo().add_moves(
+            self.filtered('is_stock_reservation').ids, sign=-1)
+        return super(StockMove, self).unlink()
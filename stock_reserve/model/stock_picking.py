@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import logging
+
+from openerp import models, fields
+
+_logger = logging.getLogger(__name__)
+
+
+class StockPicking(models.Model):
+    _inherit = 'stock.picking'
+
+    reservation_pool_date = fields.Date(
+        'Reservations of the Day',
+        readonly=True,
+        select=True,
+        copy=False,
+        help="Set on the picking shared by the stock reservations of a "
+             "warehouse on this day.")
+    reservation_pool_key = fields.Char(
+        'Reservations Key',
+        readonly=True,
+        copy=False,
+        help="Picking type, source and destination locations of the "
+             "reservations sharing this picking.")
+
+    def init(self, cr):
+        # Only one open shared picking per day and key, even when created
+        # by concurrent transactions
+        cr.execute("SELECT 1 FROM pg_indexes "
+                   "WHERE indexname = 'stock_picking_reservation_pool_index'")
+        if not cr.fetchone():
+            try:
+                with cr.savepoint():
+                    cr.execute(
+                        "CREATE UNIQUE INDEX "
+                        "stock_picking_reservation_pool_index "
+                        "ON stock_picking (reservation_pool_date, "
+                        "reservation_pool_key) "
+                        "WHERE reservation_pool_key IS NOT NULL "
+                        "AND state NOT IN ('done', 'cancel')")
+            except Exception:
+                _logger.warning('Could not create the unique index of the '
+                                'shared reservation pickings: some open '
+                                'pickings are shared twice on the same day')
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2013 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+import logging
+
+from openerp import SUPERUSER_ID, models, fields, api
+import openerp.addons.decimal_precision as dp
+
+_logger = logging.getLogger(__name__)
+
+# Key of the advisory lock preventing concurrent compactions of the summary
+SUMMARY_LOCK_KEY = 0x72737375
+
+# Sum up the moves of the reservations, in the UoM of the products
+SUMMARY_QUERY = """
+    INSERT INTO stock_reservation_summary
+        (product_id, location_id, owner_id, state, product_qty,
+         reservation_count)
+    SELECT stock_move.product_id, stock_move.location_id,
+           stock_move.restrict_partner_id, stock_move.state,
+           %%s * SUM(stock_move.product_qty), %%s * COUNT(*)
+    FROM stock_reservation
+    INNER JOIN stock_move
+         ON (stock_reservation.move_id = stock_move.id)
+    WHERE stock_move.product_id IS NOT NULL %s
+    GROUP BY 1, 2, 3, 4
+    """
+
+
+class StockReservationSummary(models.Model):
+    """ Summary of the stock reservations per product, source location,
+    owner and state
+
+    It is kept up to date when the reservations or their moves change, so
+    that the totals are read without joining the moves of all the
+    reservations. The moves are added when they are created or changed,
+    and subtracted before they are changed or deleted: the table is only
+    appended to, and the totals are the sums of its rows. Concurrent
+    transactions never update the same rows, so they don't conflict on
+    the summary. The rows are merged back by `compact`.
+    """
+    _name = 'stock.reservation.summary'
+    _description = 'Summary of the stock reservations'
+    _log_access = False
+    _order = 'product_id, location_id, owner_id, state'
+
+    @api.model
+    def _get_states(self):
+        return self.env['stock.move']._fields['state'].selection
+
+    product_id = fields.Many2one('product.product', string='Product',
+                                 readonly=True, index=True)
+    location_id = fields.Many2one('stock.location', string='Location',
+                                  readonly=True, index=True)
+    owner_id = fields.Many2one('res.partner', string='Owner', readonly=True)
+    state = fields.Selection('_get_states', string='Status', readonly=True)
+    product_qty = fields.Float(
+        string='Quantity', readonly=True,
+        digits=dp.get_precision('Product Unit of Measure'),
+        help="Quantity reserved, in the default UoM of the product")
+    reservation_count = fields.Integer(string='# Reservations',
+                                       readonly=True)
+
+    def init(self, cr):
+        # Fill the summary when the module is installed or updated
+        self.rebuild(cr, SUPERUSER_ID)
+
+    @api.model
+    def rebuild(self):
+        """ Rebuild the whole summary from the reservations """
+        _logger.info('Rebuilding the summary of the stock reservations')
+        cr = self.env.cr
+        cr.execute("LOCK TABLE stock_reservation_summary IN EXCLUSIVE MODE")
+        cr.execute("DELETE FROM stock_reservation_summary")
+        cr.execute(SUMMARY_QUERY % '', (1, 1))
+        self.invalidate_cache()
+        return True
+
+    @api.model
+    def add_moves(self, move_ids, sign=1):
+        """ Add some moves to the summary, as they are in the current
+        transaction
+
+        :param move_ids: ids of the moves; the ones which are not moves of
+                         stock reservations are ignored
+        :param sign: -1 to subtract the moves instead
+        """
+        if not move_ids:
+            return
+        self.env.cr.execute(
+            SUMMARY_QUERY % "AND stock_move.id IN %s",
+            (sign, sign, tuple(move_ids)))
+        self.invalidate_cache()
+
+    @api.model
+    def compact(self):
+        """ Merge the rows of each product, location, owner and state, and
+        delete the ones adding up to nothing
+
+        Only the rows committed before this transaction started are merged,
+        the ones added meanwhile are left untouched. Nothing is done if
+        another compaction is running.
+        """
+        cr = self.env.cr
+        cr.execute("SELECT pg_try_advisory_xact_lock(%s, 0)",
+                   (SUMMARY_LOCK_KEY,))
+        if not cr.fetchone()[0]:
+            return False
+        cr.execute("""
+            WITH merged AS (
+                DELETE FROM stock_reservation_summary
+                RETURNING product_id, location_id, owner_id, state,
+                          product_qty, reservation_count
+            )
+            INSERT INTO stock_reservation_summary
+                (product_id, location_id, owner_id, state, product_qty,
+                 reservation_count)
+            SELECT product_id, location_id, owner_id, state,
+                   SUM(product_qty), SUM(reservation_count)
+            FROM merged
+            GROUP BY product_id, location_id, owner_id, state
+            HAVING SUM(reservation_count) <> 0
+                   OR ABS(SUM(product_qty)) >= 0.000001
+            """)
+        self.invalidate_cache()
+        return True
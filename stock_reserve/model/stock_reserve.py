@@ -19,10 +19,25 @@
 #
 ##############################################################################
 
+import logging
+import threading
+
+from psycopg2 import IntegrityError
+
 from openerp import models, fields, api
 from openerp.exceptions import except_orm
+from openerp.tools import float_compare
 from openerp.tools.translate import _
 
+_logger = logging.getLogger(__name__)
+
+# Number of expired reservations released in each transaction
+RELEASE_CHUNK_SIZE = 100
+
+# Key of the advisory locks serializing the reservations of a product in a
+# location
+RESERVE_LOCK_KEY = 0x72657376
+
 
 class StockReservation(models.Model):
     """ Allow to reserve products.
@@ -59,6 +74,16 @@ class StockReservation(models.Model):
         select=1)
     date_validity = fields.Date('Validity Date')
 
+    def init(self, cr):
+        # The expiry job looks for the few reservations having a validity
+        # date, then joins their moves to check their state
+        cr.execute("SELECT 1 FROM pg_indexes "
+                   "WHERE indexname = 'stock_reservation_date_validity_index'")
+        if not cr.fetchone():
+            cr.execute("CREATE INDEX stock_reservation_date_validity_index "
+                       "ON stock_reservation (date_validity, move_id) "
+                       "WHERE date_validity IS NOT NULL")
+
     @api.model
     def default_get(self, fields_list):
         """
@@ -117,16 +142,266 @@ class StockReservation(models.Model):
 
     @api.multi
     def reserve(self):
-        """ Confirm a reservation
+        """ Confirm reservations
 
         The reservation is done using the default UOM of the product.
         A date until which the product is reserved can be specified.
+        The moves of all the reservations are confirmed together, then
+        their pickings are assigned in a single pass.
+        To wait for the reservations of the same products by other
+        transactions instead of conflicting on the quants, use
+        reserve_queued().
         """
-        self.date_expected = fields.Datetime.now()
-        self.move_id.action_confirm()
-        self.move_id.picking_id.action_assign()
+        moves = self.mapped('move_id')
+        moves.write({'date_expected': fields.Datetime.now()})
+        pooled = self._is_picking_pooled()
+        if pooled:
+            self._assign_pooled_pickings()
+        moves.action_confirm()
+        if pooled:
+            # Only assign the new moves of the shared pickings
+            moves.action_assign()
+        else:
+            moves.mapped('picking_id').action_assign()
         return True
 
+    @api.model
+    def _lock_product_locations(self, keys):
+        """ Wait until no other transaction reserves the same products in
+        the same locations
+
+        The locks are taken in a constant order to avoid deadlocks, and
+        released at the end of the transaction. They don't refresh the
+        snapshot of a transaction in repeatable read: take them before its
+        first query, or in a separate transaction as reserve_queued() does.
+
+        :param keys: list of (product id, location id)
+        """
+        for product_id, location_id in sorted(set(keys)):
+            self.env.cr.execute(
+                "SELECT pg_advisory_xact_lock(%s, hashtext(%s))",
+                (RESERVE_LOCK_KEY, '%d-%d' % (product_id, location_id)))
+
+    @api.model
+    def _is_picking_pooled(self):
+        """ Tell whether the reservations share a picking per warehouse and
+        per day """
+        return bool(self.env['ir.config_parameter'].sudo().get_param(
+            'stock_reserve.pooled_picking', False))
+
+    @api.multi
+    def _assign_pooled_pickings(self):
+        """ Put the moves of the reservations in the reservation picking of
+        their warehouse for the day, creating it if needed.
+
+        The reservations out of any warehouse keep their own picking.
+        """
+        location_obj = self.env['stock.location']
+        warehouse_obj = self.env['stock.warehouse']
+        today = fields.Date.context_today(self)
+        groups = {}
+        for reservation in self:
+            warehouse_id = location_obj.get_warehouse(reservation.location_id)
+            if not warehouse_id:
+                continue
+            key = (warehouse_id, reservation.location_id.id,
+                   reservation.location_dest_id.id)
+            groups.setdefault(key, self.browse())
+            groups[key] |= reservation
+        for (warehouse_id, location_id, location_dest_id), reservations \
+                in groups.items():
+            picking_type = warehouse_obj.browse(warehouse_id).int_type_id
+            picking = self._get_pooled_picking(
+                today, '%d-%d-%d' % (picking_type.id, location_id,
+                                     location_dest_id), picking_type)
+            if not picking:
+                continue
+            reservations.mapped('move_id').write({
+                'picking_id': picking.id,
+                'picking_type_id': picking_type.id,
+            })
+
+    @api.model
+    @api.returns('self')
+    def reserve_batch(self, vals_list):
+        """ Create and confirm several reservations at once
+
+        :param vals_list: list of dicts of values of the reservations
+        :return: the reservations
+        """
+        reservation_ids = [self.create(vals).id for vals in vals_list]
+        reservations = self.browse(reservation_ids)
+        reservations.reserve()
+        return reservations
+
+    @api.model
+    def _get_pooled_picking(self, date, key, picking_type):
+        """ Return the open reservation picking of a day and key, creating
+        it if needed.
+
+        A unique index prevents concurrent transactions from creating it
+        twice. When it was created by a transaction committed after the
+        snapshot of the current one, it can't be read here: an empty
+        recordset is returned and the reservations keep their own picking.
+        """
+        picking_obj = self.env['stock.picking']
+        domain = [('reservation_pool_date', '=', date),
+                  ('reservation_pool_key', '=', key),
+                  ('state', 'not in', ('done', 'cancel'))]
+        picking = picking_obj.search(domain, limit=1)
+        if picking:
+            return picking
+        try:
+            with self.env.cr.savepoint():
+                return picking_obj.create({
+                    'picking_type_id': picking_type.id,
+                    'origin': _('Reservations of %s') % date,
+                    'reservation_pool_date': date,
+                    'reservation_pool_key': key,
+                })
+        except IntegrityError:
+            self.invalidate_cache()
+            return picking_obj.search(domain, limit=1)
+
+    @api.model
+    def reserve_queued(self, vals_list):
+        """ Create and confirm reservations in their own transaction,
+        after the ones of the other workers on the same products and
+        locations
+
+        The locks are held by a separate transaction, so that the
+        reservations are done with a snapshot taken once the locks are
+        granted: in repeatable read, a transaction started earlier would
+        still fail to update the quants reserved meanwhile.
+        The reservations are committed before returning. The current
+        transaction must not have modified the products, locations or
+        quants reserved, or the reservations would wait for it forever.
+
+        :param vals_list: list of dicts of values of the reservations
+        :return: the ids of the reservations
+        """
+        default_location_id = self._default_location_id()
+        keys = [(vals['product_id'],
+                 vals.get('location_id') or default_location_id)
+                for vals in vals_list]
+        lock_cr = self.pool.cursor()
+        try:
+            self.with_env(self.env(cr=lock_cr))._lock_product_locations(keys)
+            cr = self.pool.cursor()
+            try:
+                reservations = self.with_env(
+                    self.env(cr=cr)).reserve_batch(vals_list)
+                reservation_ids = reservations.ids
+                cr.commit()
+            finally:
+                cr.close()
+        finally:
+            # Closing the cursor rolls back its transaction and releases the
+            # locks
+            lock_cr.close()
+        return reservation_ids
+
+    @api.model
+    def check_reservable(self, requests):
+        """ Tell whether some quantities could be reserved, without
+        reserving them or writing anything
+
+        The quantities in unreserved quants are read in one query. The
+        requests for the same product, location and owner are served in
+        order, as if they were reserved one after the other.
+
+        :param requests: list of (product id, quantity[, location id[,
+                         owner id]]) in the UoM of the products; by default
+                         the location is the default source location of the
+                         reservations, and the quants of any owner count
+        :return: list of dicts with the keys product_id, qty, location_id,
+                 owner_id, available (the quantity left for this request)
+                 and reservable, in the order of the requests
+        """
+        quant_obj = self.env['stock.quant']
+        quant_obj.check_access_rights('read')
+        default_location_id = self._default_location_id()
+        requests = [(request[0], request[1],
+                     request[2] if len(request) > 2 and request[2]
+                     else default_location_id,
+                     request[3] if len(request) > 3 and request[3] else None)
+                    for request in requests]
+        keys = list(set((product_id, location_id, owner_id)
+                        for product_id, _qty, location_id, owner_id
+                        in requests))
+        if not keys:
+            return []
+        # Only the quants the reservations could take: the ones of the
+        # company of the user, as in stock.quant's _quants_get_order, and
+        # visible under the record rules
+        company_id = (self.env.context.get('force_company') or
+                      self.env.user.company_id.id)
+        quant_query = quant_obj._where_calc(
+            [('reservation_id', '=', False),
+             ('qty', '>', 0),
+             ('company_id', '=', company_id)])
+        quant_obj._apply_ir_rules(quant_query, 'read')
+        quant_from, quant_where, quant_params = quant_query.get_sql()
+        cr = self.env.cr
+        cr.execute("""
+            WITH request (product_id, location_id, owner_id) AS (
+                VALUES %s
+            )
+            SELECT request.product_id, request.location_id, request.owner_id,
+                   COALESCE(SUM(stock_quant.qty), 0.0),
+                   MIN(product_uom.rounding)
+            FROM request
+            INNER JOIN product_product
+                 ON (product_product.id = request.product_id)
+            INNER JOIN product_template
+                 ON (product_template.id = product_product.product_tmpl_id)
+            INNER JOIN product_uom
+                 ON (product_uom.id = product_template.uom_id)
+            INNER JOIN stock_location request_location
+                 ON (request_location.id = request.location_id)
+            LEFT JOIN stock_location quant_location
+                 ON (quant_location.parent_left >= request_location.parent_left
+                     AND quant_location.parent_left <
+                         request_location.parent_right)
+            LEFT JOIN (
+                SELECT "stock_quant".product_id, "stock_quant".location_id,
+                       "stock_quant".owner_id, "stock_quant".qty
+                FROM %s
+                WHERE %s
+            ) AS stock_quant
+                 ON (stock_quant.location_id = quant_location.id
+                     AND stock_quant.product_id = request.product_id
+                     AND (request.owner_id IS NULL
+                          OR stock_quant.owner_id = request.owner_id))
+            GROUP BY request.product_id, request.location_id,
+                     request.owner_id
+            """ % (', '.join(
+                ['(%s::integer, %s::integer, %s::integer)'] * len(keys)),
+                   quant_from, quant_where),
+            [value for key in keys for value in key] + quant_params)
+        available = {}
+        roundings = {}
+        for product_id, location_id, owner_id, qty, rounding in cr.fetchall():
+            available[(product_id, location_id, owner_id)] = qty
+            roundings[product_id] = rounding
+
+        result = []
+        for product_id, qty, location_id, owner_id in requests:
+            key = (product_id, location_id, owner_id)
+            left = available.get(key, 0.0)
+            # Unknown products or locations can't be reserved
+            reservable = key in available and float_compare(
+                qty, left, precision_rounding=roundings[product_id]) <= 0
+            if reservable:
+                available[key] = left - qty
+            result.append({'product_id': product_id,
+                           'qty': qty,
+                           'location_id': location_id,
+                           'owner_id': owner_id or False,
+                           'available': left,
+                           'reservable': reservable})
+        return result
+
     @api.multi
     def release(self):
         """
@@ -136,20 +411,60 @@ class StockReservation(models.Model):
         return True
 
     @api.model
-    def release_validity_exceeded(self, ids=None):
-        """ Release all the reservation having an exceeded validity date """
+    def release_validity_exceeded(self, ids=None,
+                                  chunk_size=RELEASE_CHUNK_SIZE):
+        """ Release all the reservation having an exceeded validity date
+
+        The reservations are released by chunks, each one committed on its
+        own, so that the locks are held shortly and an error doesn't roll
+        back the other chunks. The reservations which can't be released
+        are logged and skipped.
+        """
         domain = [('date_validity', '<', fields.date.today()),
                   ('state', '=', 'assigned')]
         if ids:
             domain.append(('id', 'in', ids))
-        reserv_ids = self.search(domain)
-        reserv_ids.release()
+        reservations = self.search(domain, order='id')
+        failed_ids = []
+        for start in range(0, len(reservations), chunk_size):
+            chunk = reservations[start:start + chunk_size]
+            try:
+                with self.env.cr.savepoint():
+                    chunk.release()
+            except Exception:
+                # Release the reservations one by one to skip the culprits
+                for reservation in chunk:
+                    try:
+                        with self.env.cr.savepoint():
+                            reservation.release()
+                    except Exception:
+                        _logger.exception(
+                            'Could not release the stock reservation %d',
+                            reservation.id)
+                        failed_ids.append(reservation.id)
+            if not getattr(threading.currentThread(), 'testing', False):
+                self.env.cr.commit()
+            self.invalidate_cache()
+        if failed_ids:
+            _logger.warning('%d stock reservations having an exceeded '
+                            'validity date could not be released: %s',
+                            len(failed_ids), failed_ids)
         return True
 
+    @api.model
+    def create(self, vals):
+        vals = dict(vals, is_stock_reservation=True)
+        reservation = super(StockReservation, self).create(vals)
+        self.env['stock.reservation.summary'].sudo().add_moves(
+            reservation.move_id.ids)
+        return reservation
+
     @api.multi
     def unlink(self):
         """ Release the reservation before the unlink """
         self.release()
+        self.env['stock.reservation.summary'].sudo().add_moves(
+            self.mapped('move_id').ids, sign=-1)
         return super(StockReservation, self).unlink()
 
     @api.onchange('product_id')
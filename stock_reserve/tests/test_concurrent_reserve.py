@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import threading
+
+from openerp import SUPERUSER_ID, api
+from openerp.tests.common import TransactionCase, at_install, post_install
+
+WORKERS = 8
+STOCK_QTY = 10.0
+RESERVED_QTY = 3.0
+
+
+@at_install(False)
+@post_install(True)
+class TestConcurrentReserve(TransactionCase):
+    """Reserve the same product from several workers at the same time.
+
+    The workers need to see the product and its stock, so they are
+    committed, then removed at the end of the test."""
+
+    def setUp(self):
+        super(TestConcurrentReserve, self).setUp()
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            self.location_id = env.ref('stock.stock_location_stock').id
+            product = env['product.product'].create({
+                'name': 'Product reserved concurrently',
+                'type': 'product'})
+            env['stock.quant'].create({
+                'product_id': product.id,
+                'location_id': self.location_id,
+                'qty': STOCK_QTY})
+            self.product_id = product.id
+            cr.commit()
+
+    def tearDown(self):
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            product = env['product.product'].browse(self.product_id)
+            env['stock.reservation'].search(
+                [('product_id', '=', product.id)]).unlink()
+            env['stock.move'].search(
+                [('product_id', '=', product.id)]).unlink()
+            env['stock.quant'].search(
+                [('product_id', '=', product.id)]).unlink()
+            product.unlink()
+            cr.commit()
+        super(TestConcurrentReserve, self).tearDown()
+
+    def _reserve(self, errors):
+        with api.Environment.manage():
+            with self.registry.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                try:
+                    env['stock.reservation'].reserve_queued([{
+                        'product_id': self.product_id,
+                        'product_uom': env.ref('product.product_uom_unit').id,
+                        'product_uom_qty': RESERVED_QTY,
+                        'location_id': self.location_id,
+                        'name': 'Concurrent reservation'}])
+                except Exception as error:
+                    errors.append(error)
+
+    def test_no_over_reservation(self):
+        """Parallel reservations queue and never reserve more than the
+        stock"""
+        errors = []
+        workers = [threading.Thread(target=self._reserve, args=(errors,))
+                   for __ in range(WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertFalse(errors)
+
+        # Read the reservations committed by the workers with a new snapshot
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            reservations = env['stock.reservation'].search(
+                [('product_id', '=', self.product_id)])
+            self.assertEqual(WORKERS, len(reservations))
+            assigned = reservations.filtered(
+                lambda reservation: reservation.state == 'assigned')
+            self.assertEqual(int(STOCK_QTY // RESERVED_QTY), len(assigned))
+            quants = env['stock.quant'].search(
+                [('product_id', '=', self.product_id),
+                 ('reservation_id', '!=', False)])
+            self.assertLessEqual(sum(quants.mapped('qty')), STOCK_QTY)
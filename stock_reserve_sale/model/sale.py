@@ -79,14 +79,13 @@ class SaleOrder(models.Model):
 class SaleOrderLine(models.Model):
     _inherit = 'sale.order.line'
 
-    @api.multi
-    def _get_line_rule(self):
-        """ Get applicable rule for this product
+    @api.model
+    def _get_product_rule(self, product, warehouse):
+        """ Get applicable rule for a product sold from a warehouse
 
         Reproduce get suitable rule from procurement
         to predict source location """
         ProcurementRule = self.env['procurement.rule']
-        product = self.product_id
         product_route_ids = [x.id for x in product.route_ids +
                              product.categ_id.total_route_ids]
         rules = ProcurementRule.search([('route_id', 'in', product_route_ids)],
@@ -94,7 +93,6 @@ class SaleOrderLine(models.Model):
                                        limit=1)
 
         if not rules:
-            warehouse = self.order_id.warehouse_id
             wh_routes = warehouse.route_ids
             wh_route_ids = [route.id for route in wh_routes]
             domain = ['|', ('warehouse_id', '=', warehouse.id),
@@ -108,28 +106,50 @@ class SaleOrderLine(models.Model):
             return rules[0]
         return False
 
+    @api.multi
+    def _get_line_rule(self):
+        """ Get applicable rule for this product """
+        return self._get_product_rule(self.product_id,
+                                      self.order_id.warehouse_id)
+
+    @api.multi
+    def _get_procure_methods(self):
+        """ Get procure_method of all the lines, depending on product routes
+
+        The rule is looked up once per product and warehouse.
+
+        :return: dict mapping the line ids to their procure_method
+        """
+        rules = {}
+        procure_methods = {}
+        for line in self:
+            key = (line.product_id, line.order_id.warehouse_id)
+            if key not in rules:
+                rules[key] = self._get_product_rule(*key)
+            rule = rules[key]
+            procure_methods[line.id] = rule.procure_method if rule else False
+        return procure_methods
+
     @api.multi
     def _get_procure_method(self):
         """ Get procure_method depending on product routes """
-        rule = self._get_line_rule()
-        if rule:
-            return rule.procure_method
-        return False
+        return self._get_procure_methods()[self.id]
 
     @api.multi
     @api.depends('state',
                  'product_id.route_ids',
                  'product_id.type')
     def _is_stock_reservable(self):
+        candidates = self.filtered(
+            lambda line: (line.state == 'draft' and
+                          line.product_id and
+                          line.product_id.type != 'service' and
+                          not line.reservation_ids))
+        procure_methods = candidates._get_procure_methods()
         for line in self:
-            reservable = False
-            if (not (line.state != 'draft' or
-                     line._get_procure_method() == 'make_to_order' or
-                     not line.product_id or
-                     line.product_id.type == 'service') and
-                    not line.reservation_ids):
-                reservable = True
-            line.is_stock_reservable = reservable
+            line.is_stock_reservable = (
+                line in candidates and
+                procure_methods[line.id] != 'make_to_order')
 
     reservation_ids = fields.One2many(
         'stock.reservation',
@@ -103,12 +103,10 @@ class SaleStockReserve(models.TransientModel):
         self.ensure_one()
 
         lines = self.env['sale.order.line'].browse(line_ids)
-        for line in lines:
-            if not line.is_stock_reservable:
-                continue
-            vals = self._prepare_stock_reservation(line)
-            reserv = self.env['stock.reservation'].create(vals)
-            reserv.reserve()
+        # The reservability of all the lines is computed at once
+        lines = lines.filtered('is_stock_reservable')
+        vals_list = [self._prepare_stock_reservation(line) for line in lines]
+        self.env['stock.reservation'].reserve_batch(vals_list)
         return True
 
     @api.multi